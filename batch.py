@@ -0,0 +1,203 @@
+"""
+Resumable batch processing of origin/destination pair files
+
+Usage:
+    python -m osrm_api.batch pairs.csv result.csv --url http://localhost:5000 --workers 8
+    python -m osrm_api.batch pairs.parquet result.csv --columns olon olat dlon dlat --get duration
+
+The input (CSV, or Parquet when pyarrow is installed) is streamed `chunkSize` rows
+at a time. The pairs of a chunk are sorted and packed into /table requests with at
+most `tileSize` distinct origins and destinations each, and at most `cellsPerPair`
+cells per pair, so that pairs sharing no endpoints do not turn into mostly unused
+tables (or sent one /route request per pair with --service route), which run on a
+pool of worker threads.
+Results are appended to the output CSV chunk by chunk, and `output.ckpt` records
+how far the input and output have got, so an interrupted run started again with
+the same arguments continues from the last finished chunk. Memory use depends on
+the chunk size only, not on the size of the input.
+
+"""
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import warnings
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from . import osrm
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+def _csvChunks(path, columns, chunkSize, position):
+    """ Yield the (lon, lat, lon, lat) rows of every `chunkSize` lines of a CSV file with the byte offset after them """
+    with open(path, 'rb') as f:
+        header = next(csv.reader([f.readline().decode('utf-8-sig')]))
+        missing = [column for column in columns if column not in header]
+        if missing:
+            raise ValueError(f"columns {missing} not found in '{path}'.")
+        index = [header.index(column) for column in columns]
+        if position:
+            f.seek(position)
+        while True:
+            lines = list(itertools.islice(f, chunkSize))
+            if not lines:
+                return
+            rows = csv.reader(line.decode() for line in lines)
+            pairs = np.array([[float(row[i]) for i in index] for row in rows if row], dtype=np.float64).reshape(-1, 4)
+            yield pairs, f.tell()
+
+def _parquetChunks(path, columns, chunkSize, position):
+    """ Yield the (lon, lat, lon, lat) rows of every `chunkSize` rows of a Parquet file with the number of batches read """
+    if pq is None:
+        raise ImportError('Reading Parquet files requires pyarrow.')
+    batches = pq.ParquetFile(path).iter_batches(batch_size=chunkSize, columns=list(columns))
+    for k, batch in enumerate(batches, 1):
+        if k <= position:
+            continue
+        yield np.column_stack([batch.column(column).to_numpy(zero_copy_only=False) for column in columns]).astype(np.float64), k
+
+def _tableChunk(client, executor, pairs, get, tileSize, distUnit, timeUnit, decimals, cellsPerPair=10):
+    """ The metrics of every pair and whether each came from OSRM, packing the pairs into /table requests """
+    # 相同起點（或迄點）的 pair 排在一起，使每個 /table 請求能涵蓋盡量多的 pair
+    srcNodes, srcId = np.unique(pairs[:, :2], axis=0, return_inverse=True)
+    dstNodes, dstId = np.unique(pairs[:, 2:], axis=0, return_inverse=True)
+    srcId, dstId = srcId.ravel(), dstId.ravel()
+    order = np.lexsort((dstId, srcId))
+    metrics = osrm._parseGet(get)
+    values = {metric: np.empty(len(pairs)) for metric in metrics}
+    fromOSRM = np.empty(len(pairs), dtype=bool)
+
+    def fill(group):
+        idx = order[group]
+        src, srcPos = np.unique(srcId[idx], return_inverse=True)
+        dst, dstPos = np.unique(dstId[idx], return_inverse=True)
+        *matrices, mask = client.odMatrix(srcNodes[src], get=get, destnList=dstNodes[dst], distUnit=distUnit, timeUnit=timeUnit,
+                                          decimals=decimals, provenance=True)
+        for metric, matx in zip(metrics, matrices):
+            values[metric][idx] = matx[srcPos, dstPos]
+        fromOSRM[idx] = mask[srcPos, dstPos]
+
+    list(executor.map(fill, osrm._groupPairs(srcId[order], dstId[order], tileSize, cellsPerPair)))
+    return values, fromOSRM
+
+def _routeChunk(client, executor, pairs, get, distUnit, timeUnit, decimals):
+    """ The metrics of every pair and whether each came from OSRM, one /route request per pair """
+    metrics = osrm._parseGet(get)
+    scales = {'duration': osrm._unitScale(osrm._TIME_UNITS, timeUnit, 'timeUnit'),
+              'distance': osrm._unitScale(osrm._DIST_UNITS, distUnit, 'distUnit')}
+    routes = list(executor.map(lambda pair: client.route(pair[:2], pair[2:]), pairs.tolist()))
+    values = {metric: np.round(np.array([getattr(route, metric) for route in routes], dtype=float) / scales[metric], decimals)
+              for metric in metrics}
+    return values, np.array([route.source == 'osrm' for route in routes], dtype=bool)
+
+def _formatRows(pairs, values, fromOSRM, metrics):
+    """ The CSV text of one chunk of results; unreachable pairs are left empty """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    columns = [pairs.tolist()] + [values[metric].tolist() for metric in metrics]
+    for row in zip(*columns, fromOSRM.tolist()):
+        cells = row[0] + ['' if value != value else value for value in row[1:-1]]
+        writer.writerow(cells + ['osrm' if row[-1] else 'haversine'])
+    return buffer.getvalue().encode()
+
+def _writeCheckpoint(path, checkpoint):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+def runBatch(inputFile, outputFile, client=None, columns=('orign_lon', 'orign_lat', 'destn_lon', 'destn_lat'), get='duration;distance',
+             service='table', chunkSize=10000, tileSize=100, workers=None, distUnit='m', timeUnit='second', decimals=1, progress=None,
+             cellsPerPair=10):
+    """ Compute the metrics of every O-D pair in `inputFile` into the CSV `outputFile`, resuming an interrupted run """
+    # columns: 起點經度、起點緯度、迄點經度、迄點緯度的欄位名稱；service: 'table' 或 'route'
+    # progress: 每完成一個區塊就以 checkpoint（dict）呼叫一次
+    # cellsPerPair: 每個 /table 請求的格數最多為其 pair 數的幾倍；1 表示沒有共用起訖點的 pair 各自以 1x1 請求送出
+    client = osrm.getDefaultClient() if client is None else client
+    metrics = osrm._parseGet(get)
+    if service not in ('table', 'route'):
+        raise ValueError(f"service '{service}' not understood.")
+    isParquet = inputFile.lower().endswith(('.parquet', '.pq'))
+    stat = os.stat(inputFile)
+    params = {'input': os.path.abspath(inputFile), 'inputSize': stat.st_size, 'inputMtime': stat.st_mtime, 'columns': list(columns),
+              'get': get, 'service': service, 'chunkSize': chunkSize, 'distUnit': distUnit, 'timeUnit': timeUnit, 'decimals': decimals,
+              'profile': client.profile}
+    checkpointFile = outputFile + '.ckpt'
+    checkpoint = None
+    if os.path.exists(checkpointFile) and os.path.exists(outputFile):
+        with open(checkpointFile) as f:
+            checkpoint = json.load(f)
+        if checkpoint['params'] != params:
+            checkpoint = None
+
+    # 續跑時先截掉上次最後一個 checkpoint 之後寫出的不完整內容
+    if checkpoint is None:
+        out = open(outputFile, 'wb')
+        out.write(','.join(list(columns) + list(metrics) + ['source']).encode() + b'\n')
+        checkpoint = {'params': params, 'position': 0, 'chunks': 0, 'rows': 0, 'fallbacks': 0, 'outputOffset': out.tell()}
+    else:
+        out = open(outputFile, 'r+b')
+        out.truncate(checkpoint['outputOffset'])
+        out.seek(checkpoint['outputOffset'])
+
+    chunks = (_parquetChunks if isParquet else _csvChunks)(inputFile, columns, chunkSize, checkpoint['position'])
+    try:
+        with ThreadPoolExecutor(max_workers=workers or client.poolSize) as executor:
+            for pairs, position in chunks:
+                if service == 'table':
+                    values, fromOSRM = _tableChunk(client, executor, pairs, get, tileSize, distUnit, timeUnit, decimals, cellsPerPair)
+                else:
+                    values, fromOSRM = _routeChunk(client, executor, pairs, get, distUnit, timeUnit, decimals)
+                out.write(_formatRows(pairs, values, fromOSRM, metrics))
+                out.flush()
+                os.fsync(out.fileno())
+                checkpoint.update(position=position, chunks=checkpoint['chunks'] + 1, rows=checkpoint['rows'] + len(pairs),
+                                  fallbacks=checkpoint['fallbacks'] + int(len(fromOSRM) - np.count_nonzero(fromOSRM)),
+                                  outputOffset=out.tell())
+                _writeCheckpoint(checkpointFile, checkpoint)
+                if progress is not None:
+                    progress(checkpoint)
+    finally:
+        out.close()
+    return checkpoint
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m osrm_api.batch', description='Compute OSRM durations and distances of O-D pair files')
+    parser.add_argument('input', help='CSV or Parquet file of O-D pairs')
+    parser.add_argument('output', help='output CSV file; OUTPUT.ckpt records the progress')
+    parser.add_argument('--url', nargs='+', default=[osrm.baseURL], help='one or more OSRM servers')
+    parser.add_argument('--profile', default='driving')
+    parser.add_argument('--columns', nargs=4, default=['orign_lon', 'orign_lat', 'destn_lon', 'destn_lat'],
+                        metavar=('OLON', 'OLAT', 'DLON', 'DLAT'))
+    parser.add_argument('--get', default='duration;distance', help="'duration', 'distance' or 'duration;distance'")
+    parser.add_argument('--service', choices=['table', 'route'], default='table')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='rows read per chunk')
+    parser.add_argument('--tile-size', type=int, default=100, help='distinct origins / destinations per /table request')
+    parser.add_argument('--cells-per-pair', type=int, default=10, help='maximum cells requested per pair in a /table request')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--dist-unit', default='m')
+    parser.add_argument('--time-unit', default='second')
+    parser.add_argument('--decimals', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    client = osrm.OSRMClient(args.url, profile=args.profile, poolSize=args.workers)
+    report = lambda checkpoint: print(f"chunk {checkpoint['chunks']}: {checkpoint['rows']} rows, {checkpoint['fallbacks']} haversine fallbacks",
+                                      flush=True)
+    with warnings.catch_warnings():
+        # 備援的警告改為在每個區塊完成時統計
+        warnings.simplefilter('ignore')
+        with client:
+            checkpoint = runBatch(args.input, args.output, client, args.columns, args.get, args.service, args.chunk_size,
+                                  args.tile_size, args.workers, args.dist_unit, args.time_unit, args.decimals, progress=report,
+                                  cellsPerPair=args.cells_per_pair)
+    print(f"done: {checkpoint['rows']} rows in {checkpoint['chunks']} chunks, fallbacks by reason: {dict(client.stats.fallbacks)}")
+
+
+if __name__ == '__main__':
+    main()
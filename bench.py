@@ -0,0 +1,204 @@
+"""
+Benchmarks of the OSRM API
+
+Usage:
+    python -m osrm_api.bench client --latency 0.005 --sizes 100 500 1000 --json report.json
+    python -m osrm_api.bench decode --sizes 1000 5000 10000
+
+client: throughput, latency percentiles and peak traced memory of distance, travTime,
+        distanceMany, odMatrix (several N), distSeq and the haversine fallback paths,
+        measured against a local FakeOSRMServer (run in a separate process) so that
+        no network access is needed.
+decode: decode time and peak RSS of an N x N /table response, comparing the
+        previous `json.loads` + `np.array` path with the chunked decoder.
+        Every case runs in a fresh process so that peak RSS is measured per case.
+
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from . import osrm
+from .fakeserver import FakeOSRMServer
+
+
+def _maxRSS():
+    """ Peak resident set size of this process in MB """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+def _writeTable(path, n, seed=0):
+    """ Write a synthetic N x N /table response to `path` row by row, with a few null cells """
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as f:
+        f.write('{"code":"Ok","durations":[')
+        for i in range(n):
+            row = np.round(rng.uniform(0, 7200, n), 1).tolist()
+            row[i] = None if i % 100 == 1 else 0.0
+            f.write((',' if i else '') + json.dumps(row, separators=(',', ':')))
+        f.write(']}')
+
+def _decodeCase(path, n, method, dtype):
+    with open(path, 'rb') as f:
+        payload = f.read()
+    base = _maxRSS()
+    start = time.perf_counter()
+    if method == 'legacy':
+        # 舊的作法；加上 dtype=float 讓 null 變成 NaN，否則 np.array 會產生 object 陣列而無法運算
+        tableInfo = json.loads(payload)
+        matx = np.round(np.array(tableInfo['durations'], dtype=float) / 60, 1)
+    else:
+        matx = np.empty((n, n), dtype=dtype)
+        osrm._decodeTable(payload, ('duration',), {'duration': matx})
+        osrm._finishMatrices({'duration': matx}, ('duration',), {'duration': 60}, 1)
+    seconds = time.perf_counter() - start
+    return seconds, _maxRSS() - base, matx.nbytes / 1024 / 1024
+
+def benchDecode(sizes):
+    print(f'{"nodes":>7} {"method":>8} {"dtype":>8} {"decode (s)":>11} {"peak RSS (MB)":>14} {"result (MB)":>12}')
+    context = multiprocessing.get_context('spawn')
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'table.json')
+            _writeTable(path, n)
+            for method, dtype in (('legacy', 'float64'), ('chunked', 'float64'), ('chunked', 'float32')):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    seconds, peak, size = executor.submit(_decodeCase, path, n, method, dtype).result()
+                print(f'{n:>7} {method:>8} {dtype:>8} {seconds:>11.3f} {peak:>14.1f} {size:>12.1f}')
+
+def _randomNodes(n, seed=0):
+    """ `n` deterministic (lon, lat) nodes around Taipei """
+    rng = np.random.default_rng(seed)
+    return np.c_[rng.uniform(121.40, 121.65, n), rng.uniform(24.95, 25.15, n)].tolist()
+
+def _measure(name, func, calls):
+    """ Run `func` once per call (it returns the per-call latencies) and summarise the run """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        tracemalloc.start()
+        start = time.perf_counter()
+        latencies = func()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    latencies = np.asarray(latencies) * 1000
+    return {'case': name, 'calls': calls, 'seconds': seconds, 'throughput': calls / seconds,
+            'p50': float(np.percentile(latencies, 50)), 'p95': float(np.percentile(latencies, 95)),
+            'p99': float(np.percentile(latencies, 99)), 'peakMB': peak / 1024 / 1024}
+
+def _serve(kwargs, queue):
+    server = FakeOSRMServer(**kwargs)
+    queue.put(server.url)
+    server._server.serve_forever()
+
+@contextlib.contextmanager
+def _fakeServer(**kwargs):
+    """ Run a FakeOSRMServer in its own process so it does not count towards the client's time and memory """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_serve, args=(kwargs, queue), daemon=True)
+    process.start()
+    try:
+        yield queue.get(timeout=30)
+    finally:
+        process.terminate()
+        process.join()
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+def _timedMany(client, pairs, concurrency):
+    """ Run distanceMany over `pairs` and return the latency of every pair """
+    # 在 instance 上包住 _route，逐 pair 計時（不含等待 semaphore 的時間），而非以整批時間除以 pair 數
+    latencies, route = [], client._route
+
+    def timedRoute(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return route(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    client._route = timedRoute
+    try:
+        asyncio.run(client.distanceMany(pairs, concurrency=concurrency))
+    finally:
+        del client._route
+    return latencies
+
+def benchClient(latency=0.0, jitter=0.0, calls=200, sizes=(100, 500, 1000), tileSize=None, routeLength=2000, concurrency=10):
+    """ Benchmark the client against local fake OSRM servers, returning one report row per case """
+    nodes = _randomNodes(max(max(sizes), routeLength, calls + 1))
+    pairs = list(zip(nodes[:calls], nodes[1:calls + 1]))
+    report = []
+    with _fakeServer(latency=latency, jitter=jitter) as url:
+        client = osrm.OSRMClient(url, poolSize=concurrency, memoTTL=0)
+        report.append(_measure('distance', lambda: [_timed(client.distance, o, d) for o, d in pairs], calls))
+        report.append(_measure('travTime', lambda: [_timed(client.travTime, o, d) for o, d in pairs], calls))
+        report.append(_measure(f'distanceMany (concurrency={concurrency})', lambda: _timedMany(client, pairs, concurrency), calls))
+        for n in sizes:
+            report.append(_measure(f'odMatrix N={n}', lambda: [_timed(client.odMatrix, nodes[:n], get='duration;distance', tileSize=tileSize)], 1))
+        report.append(_measure(f'distSeq N={routeLength}', lambda: [_timed(client.distSeq, nodes[:routeLength])], 1))
+        client.close()
+
+    with _fakeServer(latency=latency, jitter=jitter, errorRate=1.0) as url:
+        # 熔斷器關閉（threshold 無限大），量測每次都收到非 Ok 回應時的備援成本
+        client = osrm.OSRMClient(url, memoTTL=0, breaker=osrm.CircuitBreaker(threshold=float('inf')))
+        report.append(_measure('distance fallback (non-Ok)', lambda: [_timed(client.distance, o, d) for o, d in pairs], calls))
+        for n in sizes:
+            report.append(_measure(f'odMatrix fallback N={n}', lambda: [_timed(client.odMatrix, nodes[:n], get='duration;distance')], 1))
+        client.close()
+
+    with _fakeServer(timeoutRate=1.0, hang=1.0) as url:
+        client = osrm.OSRMClient(url, memoTTL=0)
+        report.append(_measure('distance fallback (timeout=0.05, breaker)', lambda: [_timed(client.distance, o, d, timeout=0.05) for o, d in pairs], calls))
+        client.close()
+    return report
+
+def printReport(report):
+    print(f'{"case":<44} {"calls":>6} {"seconds":>8} {"calls/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"peak MB":>8}')
+    for row in report:
+        print(f'{row["case"]:<44} {row["calls"]:>6} {row["seconds"]:>8.3f} {row["throughput"]:>9.1f} '
+              f'{row["p50"]:>8.2f} {row["p95"]:>8.2f} {row["p99"]:>8.2f} {row["peakMB"]:>8.1f}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m osrm_api.bench', description='Benchmarks of the OSRM API')
+    commands = parser.add_subparsers(dest='command', required=True)
+    client = commands.add_parser('client', help='client throughput, latency and memory against a fake OSRM server')
+    client.add_argument('--latency', type=float, default=0.0, help='injected server latency (s)')
+    client.add_argument('--jitter', type=float, default=0.0, help='injected latency jitter (s)')
+    client.add_argument('--calls', type=int, default=200, help='calls per point-lookup case')
+    client.add_argument('--sizes', type=int, nargs='+', default=[100, 500, 1000], help='odMatrix sizes')
+    client.add_argument('--tile-size', type=int, default=None)
+    client.add_argument('--route-length', type=int, default=2000, help='number of nodes for distSeq')
+    client.add_argument('--concurrency', type=int, default=10)
+    client.add_argument('--json', help='also write the report to this JSON file')
+    decode = commands.add_parser('decode', help='decode time and peak RSS of N x N /table responses')
+    decode.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 10000])
+    args = parser.parse_args(argv)
+
+    if args.command == 'client':
+        report = benchClient(args.latency, args.jitter, args.calls, args.sizes, args.tile_size, args.route_length, args.concurrency)
+        printReport(report)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+    elif args.command == 'decode':
+        benchDecode(args.sizes)
+
+
+if __name__ == '__main__':
+    main()
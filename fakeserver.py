@@ -0,0 +1,223 @@
+"""
+A local stand-in of the OSRM HTTP API for benchmarks and offline testing
+
+The server implements `/route/v1/{profile}/{coordinates}` and
+`/table/v1/{profile}/{coordinates}`, with plain, polyline or polyline6
+coordinates, and gives synthetic but deterministic answers: the distance
+between two points is their haversine distance times `detour`, and the
+duration is that distance driven at `speed` km/h.
+
+Every waypoint carries a hint (the coordinate and the data `checksum`, URL-safe
+base64 like OSRM's); coordinates sent without a valid hint cost `snapLatency`
+extra seconds each, standing in for the server snapping them to the road network.
+
+Latency, jitter, OSRM error codes, HTTP 5xx errors and hanging requests
+(timeouts) can be injected:
+
+    with FakeOSRMServer(latency=0.01, jitter=0.005, errorRate=0.05) as server:
+        client = osrm.OSRMClient(server.url)
+
+or from the command line:
+
+    python -m osrm_api.fakeserver --port 5000 --latency 0.01
+
+"""
+import argparse
+import base64
+import json
+import random
+import struct
+import threading
+import time
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from .osrm import decodePolyline, haversineMatrix, haversinePairs
+
+
+class FakeOSRMServer:
+    """ Threaded HTTP server answering /route and /table requests like OSRM """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, errorRate=0.0, errorCode='NoRoute',
+                 serverErrorRate=0.0, timeoutRate=0.0, hang=30.0, detour=1.3, speed=40, seed=0,
+                 snapLatency=0.0, checksum=1):
+        # latency / jitter: 每個請求額外等待 latency ± jitter 秒
+        # errorRate: 回傳 OSRM 錯誤碼 errorCode 的比例；serverErrorRate: 回傳 HTTP 503 的比例
+        # timeoutRate: 等待 hang 秒才回應（模擬逾時）的比例
+        # snapLatency: 每個未附有效 hint 的座標額外等待的秒數；checksum: 地圖資料的 checksum，改變後舊的 hint 失效
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.errorCode = errorCode
+        self.serverErrorRate = serverErrorRate
+        self.timeoutRate = timeoutRate
+        self.hang = hang
+        self.detour = detour
+        self.speed = speed
+        self.snapLatency = snapLatency
+        self.checksum = checksum
+        self.requests = 0
+        self.snapped = 0
+        self.hinted = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _handlerFor(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def answer(self, service, coordinates, query):
+        """ The (HTTP status, JSON body) answering `service` for `coordinates` """
+        with self._lock:
+            self.requests += 1
+            draw = self._random.random()
+            delay = max(self.latency + self._random.uniform(-self.jitter, self.jitter), 0.0)
+        if draw < self.timeoutRate:
+            delay += self.hang
+        time.sleep(delay)
+        draw -= self.timeoutRate
+        if 0 <= draw < self.serverErrorRate:
+            return 503, {'message': 'Service Unavailable'}
+        draw -= self.serverErrorRate
+        if 0 <= draw < self.errorRate:
+            return 400, {'code': self.errorCode, 'message': 'Injected error'}
+
+        try:
+            nodes = np.array(self._coordinates(coordinates), dtype=np.float64).reshape(-1, 2)
+        except (ValueError, IndexError):
+            return 400, {'code': 'InvalidQuery', 'message': 'Query string malformed'}
+        hints = query.get('hints', [''])[0].split(';') if 'hints' in query else []
+        if hints and (len(hints) != len(nodes)):
+            return 400, {'code': 'InvalidOptions', 'message': 'Number of hints does not match the number of coordinates'}
+        hinted = sum(self._validHint(hint, node) for hint, node in zip(hints, nodes.tolist()))
+        with self._lock:
+            self.hinted += hinted
+            self.snapped += len(nodes) - hinted
+        time.sleep(self.snapLatency * (len(nodes) - hinted))
+        if service == 'route':
+            return 200, self._route(nodes, query)
+        elif service == 'table':
+            return 200, self._table(nodes, query)
+        return 400, {'code': 'InvalidService', 'message': f'Service {service} not found!'}
+
+    def _coordinates(self, coordinates):
+        """ Parse 'lon,lat;lon,lat;...', 'polyline(...)' or 'polyline6(...)' into (lon, lat) nodes """
+        for name, precision in (('polyline(', 5), ('polyline6(', 6)):
+            if coordinates.startswith(name) and coordinates.endswith(')'):
+                return decodePolyline(coordinates[len(name):-1], precision)
+        return [[float(x) for x in node.split(',')] for node in coordinates.split(';')]
+
+    def hint(self, node):
+        """ The hint of `node`: its coordinate followed by the 4-byte data checksum, in URL-safe base64 """
+        return base64.urlsafe_b64encode(struct.pack('<ddI', node[0], node[1], self.checksum)).decode().rstrip('=')
+
+    def _validHint(self, hint, node):
+        try:
+            lon, lat, checksum = struct.unpack('<ddI', base64.urlsafe_b64decode(hint + '=' * (-len(hint) % 4)))
+        except (ValueError, struct.error):
+            return False
+        return (checksum == self.checksum) and (abs(lon - node[0]) < 1e-5) and (abs(lat - node[1]) < 1e-5)
+
+    def _waypoints(self, nodes):
+        return [{'hint': self.hint(node), 'distance': 0, 'name': '', 'location': node} for node in nodes.tolist()]
+
+    def _route(self, nodes, query):
+        distances = np.round(haversinePairs(nodes[:-1], nodes[1:]) * self.detour, 1)
+        durations = np.round(distances / (self.speed/3.6), 1)
+        legs = [{'distance': distance, 'duration': duration, 'summary': '', 'steps': [], 'weight': duration}
+                for distance, duration in zip(distances.tolist(), durations.tolist())]
+        route = {'distance': round(float(distances.sum()), 1), 'duration': round(float(durations.sum()), 1), 'legs': legs,
+                 'weight_name': 'routability', 'weight': round(float(durations.sum()), 1)}
+        if query.get('overview', ['simplified'])[0] != 'false':
+            route['geometry'] = ''
+        return {'code': 'Ok', 'routes': [route], 'waypoints': self._waypoints(nodes)}
+
+    def _table(self, nodes, query):
+        def index(name):
+            value = query.get(name, ['all'])[0]
+            return np.arange(len(nodes)) if value == 'all' else np.array([int(i) for i in value.split(';')])
+        sources, destinations = index('sources'), index('destinations')
+        distances = np.round(haversineMatrix(nodes[sources], nodes[destinations]) * self.detour, 1)
+        info = {'code': 'Ok', 'sources': self._waypoints(nodes[sources]), 'destinations': self._waypoints(nodes[destinations])}
+        annotations = query.get('annotations', ['duration'])[0].split(',')
+        if 'duration' in annotations:
+            info['durations'] = np.round(distances / (self.speed/3.6), 1).tolist()
+        if 'distance' in annotations:
+            info['distances'] = distances.tolist()
+        return info
+
+
+def _handlerFor(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True      # 標頭與內容分開寫出，未關閉 Nagle 時 keep-alive 連線每個請求會多等約 40 ms
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            parts = url.path.split('/')
+            if len(parts) != 5:
+                status, info = 400, {'code': 'InvalidUrl', 'message': 'URL string malformed'}
+            else:
+                status, info = server.answer(parts[1], unquote(parts[4]), parse_qs(url.query))
+            body = json.dumps(info, separators=(',', ':')).encode()
+            try:
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass    # 用戶端已逾時放棄
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m osrm_api.fakeserver', description='A local stand-in of the OSRM HTTP API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-code', default='NoRoute')
+    parser.add_argument('--server-error-rate', type=float, default=0.0)
+    parser.add_argument('--timeout-rate', type=float, default=0.0)
+    parser.add_argument('--snap-latency', type=float, default=0.0, help='extra seconds per coordinate sent without a valid hint')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = FakeOSRMServer(args.host, args.port, latency=args.latency, jitter=args.jitter, errorRate=args.error_rate,
+                            errorCode=args.error_code, serverErrorRate=args.server_error_rate,
+                            timeoutRate=args.timeout_rate, seed=args.seed, snapLatency=args.snap_latency)
+    print(f'Fake OSRM server listening on {server.url}')
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        server._server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,491 +1,1850 @@
-import requests
+import asyncio
+import base64
+import bisect
+import hashlib
+import itertools
 import json
+import os
+import re
+import requests
 import numpy as np
-import haversine as hs
+import sqlite3
+import threading
+import time
 import warnings
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import partial
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote
+from urllib3.util.retry import Retry
+
+try:
+    # orjson 解析大型 /table 回應的速度遠快於內建的 json，有安裝時優先使用
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+try:
+    # 有安裝 scipy 時以 KD-tree 選出鄰近點，否則改為分塊的暴力搜尋
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
 
 
 __version__ = '1.0.1'
 
 
+# 模組層級的函式所用的伺服器；沿用舊版程式修改 tableURL / routeURL 的寫法也會生效
+baseURL = 'http://router.project-osrm.org'
 tableURL = 'http://router.project-osrm.org/table/v1/driving/'
 routeURL = 'http://router.project-osrm.org/route/v1/driving/'
+_INITIAL_URLS = {'table': tableURL, 'route': routeURL}
 
 
-def distance(orign, destn, unit='m', steps='false', timeout=5):
-    """ Get the distance between `orign` and `destn` """
-    newURL = routeURL + f'{orign[0]},{orign[1]};{destn[0]},{destn[1]}' + f'?steps={steps}'
-    try:
-        r = requests.get(newURL, timeout=timeout)
-    except requests.exceptions.Timeout:
-        warnings.warn('Exceed the maximum timeout to request, so use the haversine distance instead.')
-        if (unit == 'm'):
-            return hs.haversine((orign[1],orign[0]),(destn[1],destn[0]), unit=hs.Unit.METERS)
-        elif (unit == 'km'):
-            return hs.haversine((orign[1],orign[0]),(destn[1],destn[0]), unit=hs.Unit.KILOMETERS)
-        else:
-            raise ValueError(f"unit '{unit}' not understood.")
-    
-    routeInfo = json.loads(r.content)
-    if (routeInfo['code'] == 'Ok'):
-        if (steps == 'false'):
-            if (unit == 'm'):
-                return routeInfo['routes'][0]['legs'][0]['distance']
-            elif (unit == 'km'):
-                return routeInfo['routes'][0]['legs'][0]['distance'] / 1000
-            else:
-                raise ValueError(f"unit '{unit}' not understood.")
-        elif (steps == 'true'):
-            if (unit == 'm'):
-                return routeInfo['routes'][0]['legs'][0]['distance'], routeInfo['routes'][0]['legs'][0]['summary']
-            elif (unit == 'km'):
-                return routeInfo['routes'][0]['legs'][0]['distance'] / 1000, routeInfo['routes'][0]['legs'][0]['summary']
-            else:
-                raise ValueError(f"unit '{unit}' not understood.")
-    else:
-        warnings.warn('Fail to get data from the OSRM API, so use the haversine distance instead.')
-        if (unit == 'm'):
-            return hs.haversine((orign[1],orign[0]),(destn[1],destn[0]), unit=hs.Unit.METERS)
-        elif (unit == 'km'):
-            return hs.haversine((orign[1],orign[0]),(destn[1],destn[0]), unit=hs.Unit.KILOMETERS)
-        else:
-            raise ValueError(f"unit '{unit}' not understood.")
+EARTH_RADIUS = 6371008.8    # meters, the mean earth radius also used by the `haversine` package
 
-def travTime(orign, destn, unit='second', steps='false', timeout=5, speed=30):
-    """ Get the travel time between `orign` and `destn` """
-    newURL = routeURL + f'{orign[0]},{orign[1]};{destn[0]},{destn[1]}' + f'?steps={steps}'
+_DIST_UNITS = {'m': 1, 'km': 1000}
+_TIME_UNITS = {'second': 1, 'minute': 60, 'hour': 60 * 60}
+
+
+def _haversine(lon1, lat1, lon2, lat2):
+    """ Broadcast the haversine formula over radian arrays, result in meters """
+    h = np.sin((lat2 - lat1) / 2)
+    h *= h
+    a = np.sin((lon2 - lon1) / 2)
+    a *= a
+    a *= np.cos(lat1)
+    a *= np.cos(lat2)
+    h += a
+    np.minimum(h, 1, out=h)
+    np.sqrt(h, out=h)
+    np.arcsin(h, out=h)
+    h *= 2 * EARTH_RADIUS
+    return h
+
+def _radians(nodeList, dtype):
+    return np.radians(np.asarray(nodeList, dtype=dtype).reshape(-1, 2))
+
+def haversineMatrix(orignList, destnList=None, dtype=np.float64):
+    """ Get the haversine distances (m) from every node in `orignList` to every node in `destnList` """
+    # nodes are (lon, lat) as for OSRM; a len(orignList) x len(destnList) matrix is returned
+    orign = _radians(orignList, dtype)
+    destn = orign if destnList is None else _radians(destnList, dtype)
+    return _haversine(orign[:, 0, None], orign[:, 1, None], destn[None, :, 0], destn[None, :, 1])
+
+def haversinePairs(orignList, destnList, dtype=np.float64):
+    """ Get the haversine distances (m) between the paired nodes of `orignList` and `destnList` """
+    orign = _radians(orignList, dtype)
+    destn = _radians(destnList, dtype)
+    return _haversine(orign[:, 0], orign[:, 1], destn[:, 0], destn[:, 1])
+
+def _unitScale(units, unit, name):
     try:
-        r = requests.get(newURL, timeout=timeout)
-    except requests.exceptions.Timeout:
-        warnings.warn('Exceed the maximum timeout to request, so use the haversine distance instead.')
-        hsDist = hs.haversine((orign[1],orign[0]),(destn[1],destn[0]), unit=hs.Unit.METERS)
-        if (unit == 'second'):
-            speed /= 3.6
-            return hsDist/speed
-        elif (unit == 'minute'):
-            speed /= 3.6
-            return (hsDist/speed)/60
-        elif (unit == 'hour'):
-            return (hsDist/1000)/speed
-        else:
-            raise ValueError(f"unit '{unit}' not understood.")
-    
-    routeInfo = json.loads(r.content)
-    if (routeInfo['code'] == 'Ok'):
-        if (steps == 'false'):
-            if (unit =='second'):
-                return routeInfo['routes'][0]['legs'][0]['duration']
-            elif (unit == 'minute'):
-                return routeInfo['routes'][0]['legs'][0]['duration'] / 60
-            elif (unit == 'hour'):
-                return routeInfo['routes'][0]['legs'][0]['duration'] / 60 / 60
-            else:
-                raise ValueError(f"unit '{unit}' not understood.")
-        elif (steps == 'true'):
-            if (unit =='second'):
-                return routeInfo['routes'][0]['legs'][0]['duration'], routeInfo['routes'][0]['legs'][0]['summary']
-            elif (unit == 'minute'):
-                return routeInfo['routes'][0]['legs'][0]['duration'] / 60, routeInfo['routes'][0]['legs'][0]['summary']
-            elif (unit == 'hour'):
-                return routeInfo['routes'][0]['legs'][0]['duration'] / 60 / 60, routeInfo['routes'][0]['legs'][0]['summary']
-            else:
-                raise ValueError(f"unit '{unit}' not understood.")
-    else:
-        warnings.warn('Fail to get data from the OSRM API, so use the haversine distance instead.')
-        hsDist = hs.haversine((orign[1],orign[0]),(destn[1],destn[0]), unit=hs.Unit.METERS)
-        if (unit == 'second'):
-            speed /= 3.6
-            return hsDist/speed
-        elif (unit == 'minute'):
-            speed /= 3.6
-            return (hsDist/speed)/60
-        elif (unit == 'hour'):
-            return (hsDist/1000)/speed
-        else:
-            raise ValueError(f"unit '{unit}' not understood.")
+        return units[unit]
+    except KeyError:
+        raise ValueError(f"{name} '{unit}' not understood.") from None
 
-def odMatrix(nodeList, get='distance', sources=None, distUnit='m', timeUnit='second', timeout=5, speed=30, decimals=1):
-    """ Get the O-D Matrix from all nodes in `nodeList` """
-    # nodeList: [(), (), ... , ()]
+def _parseGet(get):
     get = get.replace(' ', '')
-    nodes = ''
-    for i, node in enumerate(nodeList):
-        if (i < len(nodeList)-1):
-            nodes += str(node[0]) + ',' + str(node[1]) + ';'
-        else:
-            nodes += str(node[0]) + ',' + str(node[1])
-    
-    # sources = 0 will return 1xN matrix
-    if sources == 0:
-        nodes += '?sources=0'
-        # 依據 get 參數決定回傳的值
-        if (get == 'duration'):
-            nodes += f'&annotations={get}'
-            newURL = tableURL + nodes            
-            try:
-                r = requests.get(newURL, timeout=timeout)
-            except requests.exceptions.Timeout:
-                warnings.warn('Exceed the maximum timeout to request, so use the haversine distance here.')
-                timeMatx = []
-                row = []
-                for y in nodeList:
-                    hsDist = hs.haversine((nodeList[0][1],nodeList[0][0]),(y[1],y[0]), unit=hs.Unit.METERS)
-                    if (timeUnit == 'second'):
-                        row.append(hsDist/(speed/3.6))
-                    elif (timeUnit == 'minute'):
-                        row.append((hsDist/(speed/3.6))/60)
-                    elif (timeUnit == 'hour'):
-                        row.append((hsDist/(speed/3.6))/60/60)
-                    else:
-                        raise ValueError(f"timeUnit '{timeUnit}' not understood.")
-                timeMatx.append(row)
-                return np.round(np.array(timeMatx), decimals)
-            
-            tableInfo = json.loads(r.content)
-            if (tableInfo['code'] == 'Ok'):
-                if (timeUnit == 'second'):
-                    return np.array(tableInfo['durations'])
-                elif (timeUnit == 'minute'):
-                    return np.round(np.array(tableInfo['durations'])/60, decimals)
-                elif (timeUnit == 'hour'):
-                    return np.round(np.array(tableInfo['durations'])/60/60, decimals)
+    if (get == 'duration') or (get == 'distance'):
+        return (get,)
+    elif (get == 'duration;distance') or (get == 'distance;duration'):
+        return ('duration', 'distance')
+    else:
+        raise ValueError(f"get '{get}' not understood.")
+
+def _fallbackMatrices(orignList, destnList, metrics, speed, dtype):
+    """ Haversine substitutes of the OSRM durations (s) and distances (m) """
+    hsDist = haversineMatrix(orignList, destnList, dtype)
+    if 'distance' not in metrics:
+        hsDist /= speed/3.6
+        return {'duration': hsDist}
+    elif 'duration' not in metrics:
+        return {'distance': hsDist}
+    return {'duration': hsDist / (speed/3.6), 'distance': hsDist}
+
+def _indexArray(index, size, name):
+    """ Turn `sources` / `destinations` (None, an int or a list of ints) into an index array """
+    if index is None:
+        return np.arange(size)
+    index = np.atleast_1d(np.asarray(index, dtype=np.int64))
+    if (index.ndim != 1) or np.any(index < 0) or np.any(index >= size):
+        raise ValueError(f"{name} '{index.tolist()}' not understood.")
+    return index
+
+def encodePolyline(nodeList, precision=5):
+    """ Encode the (lon, lat) nodes of `nodeList` as a polyline string (precision 5: 'polyline', 6: 'polyline6') """
+    # polyline 依 Google 的格式以 (lat, lon) 順序記錄相鄰兩點的差值；整個編碼以 numpy 一次完成
+    nodeArr = np.asarray(nodeList, dtype=np.float64).reshape(-1, 2)
+    values = np.round(nodeArr[:, ::-1] * 10**precision).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    zigzag = (deltas << 1) ^ (deltas >> 63)
+    shifts = np.arange(0, 40, 5)
+    chunks = (zigzag[:, None] >> shifts) & 31
+    lengths = np.maximum(np.count_nonzero((zigzag[:, None] >> shifts) > 0, axis=1), 1)
+    position = np.arange(len(shifts))
+    chunks[position < (lengths[:, None] - 1)] |= 0x20
+    return (chunks[position < lengths[:, None]] + 63).astype(np.uint8).tobytes().decode()
+
+def decodePolyline(polyline, precision=5):
+    """ Decode a polyline string (e.g. Route.geometry) into a list of (lon, lat) nodes """
+    values, value, shift = [], 0, 0
+    for char in polyline.encode():
+        chunk = char - 63
+        value |= (chunk & 31) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    latLon = np.cumsum(np.array(values, dtype=np.int64).reshape(-1, 2), axis=0) / 10**precision
+    return [(lon, lat) for lat, lon in latLon.tolist()]
+
+_ENCODINGS = {'plain': None, 'polyline': 5, 'polyline6': 6}
+
+def _formatCoordinates(nodeList, encoding='plain', precision=None):
+    """ The coordinates part of an OSRM URL: 'lon,lat;lon,lat;...' or URL-quoted 'polyline(...)' / 'polyline6(...)' """
+    # precision: 'plain' 時座標四捨五入的小數位數，None 表示完整精度；polyline 的精度固定為 5 或 6 位
+    if encoding not in _ENCODINGS:
+        raise ValueError(f"encoding '{encoding}' not understood.")
+    if encoding != 'plain':
+        return f'{encoding}(' + quote(encodePolyline(nodeList, _ENCODINGS[encoding]), safe='') + ')'
+    nodes = np.asarray(nodeList, dtype=np.float64).reshape(-1, 2).tolist()
+    if precision is None:
+        return ';'.join(f'{x},{y}' for x, y in nodes)
+    return ';'.join(f'{round(x, precision)},{round(y, precision)}' for x, y in nodes)
+
+def _tiles(nRows, nCols, tileSize):
+    """ Split a nRows x nCols matrix into (rows, cols) slices of at most tileSize x tileSize """
+    if tileSize is None:
+        return [(slice(0, nRows), slice(0, nCols))]
+    return [(slice(r, min(r + tileSize, nRows)), slice(c, min(c + tileSize, nCols)))
+            for r in range(0, nRows, tileSize) for c in range(0, nCols, tileSize)]
+
+def _requestCost(blocks, tileSize, requestCells=1000):
+    """ Rough cost of requesting (rows, cols) `blocks`, counting each request as `requestCells` cells of overhead """
+    return sum(len(_tiles(len(rows), len(cols), tileSize)) * requestCells + len(rows) * len(cols) for rows, cols in blocks)
+
+def _groupPairs(srcId, dstId, tileSize, cellsPerPair=None):
+    """ Split the sorted pairs into consecutive slices with at most `tileSize` distinct origins and destinations each """
+    # cellsPerPair: 另外限制每個 slice 的（起點數 x 迄點數）不超過 pair 數的 cellsPerPair 倍，
+    # 避免起訖點各不相同的 pair 合併成一個大多是用不到格子的 /table 請求
+    groups, start = [], 0
+    srcs, dsts = set(), set()
+    for k, (i, j) in enumerate(zip(srcId.tolist(), dstId.tolist())):
+        nSrc, nDst = len(srcs) + (i not in srcs), len(dsts) + (j not in dsts)
+        if (k > start) and ((nSrc > tileSize) or (nDst > tileSize) or
+                            ((cellsPerPair is not None) and (nSrc * nDst > cellsPerPair * (k - start + 1)))):
+            groups.append(slice(start, k))
+            start = k
+            srcs, dsts = set(), set()
+        srcs.add(i)
+        dsts.add(j)
+    if start < len(srcId):
+        groups.append(slice(start, len(srcId)))
+    return groups
+
+def _decodeRows(rows, out):
+    """ Copy the nested rows of a /table response into the preallocated `out`, null becoming NaN """
+    # 逐列複製並立即釋放該列的 Python float，避免整個巢狀 list 再轉成一份完整的暫存陣列；
+    # 列數或列長與請求不符時拋出 ValueError，交由 _tableTile 改用 haversine，而非讓 numpy broadcast 或留下未初始化的值
+    if len(rows) != len(out):
+        raise ValueError(f'{len(rows)} rows in the /table response, {len(out)} expected.')
+    for i in range(len(rows)):
+        if (not isinstance(rows[i], list)) or (len(rows[i]) != out.shape[1]):
+            raise ValueError(f'row {i} of the /table response does not have {out.shape[1]} cells.')
+        out[i] = rows[i]
+        rows[i] = None
+
+def _decodeTable(tableInfo, metrics, outs, chunkBytes=1 << 22):
+    """ Decode the `metrics` of an Ok /table response (raw bytes or an already parsed dict) into `outs` """
+    # 原始回應不整份解析成巢狀 list，而是每次只解析約 chunkBytes 的列再複製進 outs，
+    # 峰值記憶體約為回應本身加上一個區塊；格式不如預期時改為整份解析
+    if isinstance(tableInfo, bytes):
+        for metric in metrics:
+            if not _decodeChunks(tableInfo, metric, outs[metric], chunkBytes):
+                return _decodeTable(_loads(tableInfo), metrics, outs)
+        return
+    for metric in metrics:
+        _decodeRows(tableInfo[metric + 's'], outs[metric])
+
+def _decodeChunks(content, metric, out, chunkBytes):
+    key = b'"' + metric.encode() + b's":['
+    start = content.find(key)
+    if start < 0:
+        return False
+    pos = start + len(key)
+    end = content.find(b']]', pos) + 1
+    if end <= 0:
+        return content.startswith(b']', pos) and len(out) == 0
+    row = 0
+    while pos < end:
+        cut = content.find(b'],[', pos + chunkBytes, end)
+        stop = end if cut < 0 else cut + 1
+        rows = _loads(b'[' + content[pos:stop] + b']')
+        if row + len(rows) > len(out):
+            return False
+        _decodeRows(rows, out[row:row + len(rows)])
+        row += len(rows)
+        pos = stop + 1
+    return row == len(out)
+
+def _superdiagonal(matrix):
+    """ The (i, i+1) cells of `matrix`, i.e. the consecutive legs of an O-D matrix """
+    seq = []
+    i = 0
+    j = 1
+    while i < matrix.shape[0]-1:
+        while j < matrix.shape[1]:
+            seq.append(matrix[i][j])
+            i += 1
+            j += 1
+    return seq
+
+def _finishMatrices(matrices, metrics, scales, decimals, nullValue=np.nan):
+    """ Convert the units and round in place, returning a matrix or (timeMatx, distMatx) """
+    for metric in metrics:
+        matx = matrices[metric]
+        if scales[metric] != 1:
+            matx /= scales[metric]
+        np.round(matx, decimals, out=matx)
+        if nullValue == nullValue:
+            np.copyto(matx, nullValue, where=np.isnan(matx))
+    if len(metrics) == 1:
+        return matrices[metrics[0]]
+    return matrices['duration'], matrices['distance']
+
+
+# source: 'osrm' 或 'haversine'（備援值）
+Route = namedtuple('Route', ['distance', 'duration', 'summary', 'geometry', 'source'])
+
+
+# 與 scipy.sparse.csr_matrix((data, indices, indptr), shape=shape) 的參數相同
+CSRMatrix = namedtuple('CSRMatrix', ['data', 'indices', 'indptr', 'shape'])
+
+
+def _nearestNeighbours(nodeArr, k, memoryBudget=64 * 2**20):
+    """ The indices (N x k) of the k nearest other nodes of every node by great-circle distance """
+    if cKDTree is not None:
+        # 單位球面上的直線距離與大圓距離單調相關，可直接用三維 KD-tree 查詢
+        lon, lat = _radians(nodeArr, np.float64).T
+        xyz = np.c_[np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]
+        index = cKDTree(xyz).query(xyz, k + 1)[1].reshape(len(nodeArr), k + 1)
+        # 去掉自己；座標重複時自己可能不在結果中，此時去掉最遠的一個
+        keep = index != np.arange(len(nodeArr))[:, None]
+        keep[keep.all(axis=1), -1] = False
+        return index[keep].reshape(len(nodeArr), k)
+
+    # 沒有 scipy 時逐塊計算到所有點的 haversine 距離，時間為 O(N²)（10 萬個點約需數分鐘）；
+    # 每塊約有 6 個 rows x N 的 8 bytes 暫存陣列，依 memoryBudget（bytes）決定每塊列數，使峰值記憶體不隨 N 平方成長
+    chunkSize = max(int(memoryBudget // (6 * 8 * len(nodeArr))), 1)
+    neighbours = np.empty((len(nodeArr), k), dtype=np.int64)
+    for start in range(0, len(nodeArr), chunkSize):
+        rows = np.arange(start, min(start + chunkSize, len(nodeArr)))
+        dist = haversineMatrix(nodeArr[rows], nodeArr)
+        dist[np.arange(len(rows)), rows] = np.inf
+        neighbours[rows] = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    return neighbours
+
+def _mortonOrder(nodeArr):
+    """ The order of the nodes along a Z-order curve, so that consecutive nodes lie close to each other """
+    span = np.maximum(np.ptp(nodeArr, axis=0), 1e-12)
+    cells = ((nodeArr - nodeArr.min(axis=0)) / span * 0xFFFF).astype(np.uint64)
+    def spread(v):
+        for shift, mask in ((8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333), (1, 0x55555555)):
+            v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+        return v
+    return np.argsort(spread(cells[:, 0]) | (spread(cells[:, 1]) << np.uint64(1)), kind='stable')
+
+
+def _fallbackRoute(orign, destn, speed):
+    hsDist = float(haversinePairs(orign, destn)[0])
+    return Route(hsDist, hsDist / (speed/3.6), '', None, 'haversine')
+
+
+class ODCache:
+    """ Cache of OSRM durations (s) and distances (m), a bounded in-memory LRU of origin rows in front of an optional SQLite file """
+
+    def __init__(self, path=None, maxSize=5000000, ttl=None, precision=5):
+        # path: SQLite 檔案位置，None 表示只使用記憶體
+        # maxSize: 記憶體中最多保存的格數（每格約 24 bytes），以起點為單位淘汰最久未用的列
+        # ttl: 資料有效秒數，地圖更新後過期的資料會被視為未命中；None 表示永不過期
+        # precision: 座標四捨五入的小數位數，作為快取鍵的一部分
+        # 每個座標對應一個整數 id；每個 (profile, metric, 起點) 存成一列：排序過的迄點 id 與對應的數值、更新時間，
+        # 整個矩陣的查詢與寫入都以 numpy 逐列批次處理，不必為每一格建立字串鍵。
+        # 逐格寫入（route() 的結果）先放在該列的 pending（dict）並寫入 SQLite 的 odcell 表，
+        # 累積超過該列四分之一（至少 64 格）時才併入排序陣列並重寫整列，避免每次寫入都重寫越來越長的列
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self._ids = {}
+        self._rows = OrderedDict()   # (profile, metric, 起點 id) -> [迄點 ids, 數值, 更新時間, pending]
+        self._cells = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS node (key TEXT PRIMARY KEY, id INTEGER UNIQUE)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS odrow (profile TEXT, metric TEXT, orign INTEGER, destns BLOB, vals BLOB, '
+                             'updated BLOB, PRIMARY KEY (profile, metric, orign))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS odcell (profile TEXT, metric TEXT, orign INTEGER, destn INTEGER, value REAL, '
+                             'updated REAL, PRIMARY KEY (profile, metric, orign, destn))')
+            self._db.commit()
+            self._ids = dict(self._db.execute('SELECT key, id FROM node'))
+
+    def nodeKey(self, node):
+        return f'{node[0]:.{self.precision}f},{node[1]:.{self.precision}f}'
+
+    def nodeIds(self, nodeList):
+        """ The integer ids of the nodes in `nodeList`, assigning new ids to unseen nodes """
+        return self._keyIds([self.nodeKey(node) for node in np.asarray(nodeList, dtype=np.float64).reshape(-1, 2).tolist()])
+
+    def _keyIds(self, keys):
+        with self._lock:
+            new = [key for key in dict.fromkeys(keys) if key not in self._ids]
+            if new:
+                items = [(key, len(self._ids) + i) for i, key in enumerate(new)]
+                self._ids.update(items)
+                if self._db is not None:
+                    # 與之後寫入的數值一起 commit；未寫入任何數值便關閉時，未使用的 id 不需保存
+                    self._db.executemany('INSERT INTO node (key, id) VALUES (?, ?)', items)
+            return np.array([self._ids[key] for key in keys], dtype=np.int64)
+
+    def key(self, profile, orign, destn, metric):
+        """ The cache key of `metric` ('duration' or 'distance') from `orign` to `destn` """
+        return (profile, metric, self.nodeKey(orign), self.nodeKey(destn))
+
+    def get(self, key):
+        return self.getMany([key])[0]
+
+    def getMany(self, keys):
+        """ Get the cached values of `keys`, with None for every miss """
+        now = time.time()
+        values = [None] * len(keys)
+        with self._lock:
+            for i, (profile, metric, orign, destn) in enumerate(keys):
+                if (orign not in self._ids) or (destn not in self._ids):
+                    continue
+                row = self._loadRows(profile, metric, [self._ids[orign]]).get(self._ids[orign])
+                if row is not None:
+                    value = self._match(row, np.array([self._ids[destn]]), now)[0]
+                    values[i] = None if value != value else float(value)
+            hitCount = sum(value is not None for value in values)
+            self.hits += hitCount
+            self.misses += len(keys) - hitCount
+        return values
+
+    def getMatrix(self, profile, metric, orignList, destnList):
+        """ The cached `metric` from every node in `orignList` to every node in `destnList`, NaN for every miss """
+        srcIds, dstIds = self.nodeIds(orignList), self.nodeIds(destnList)
+        values = np.full((len(srcIds), len(dstIds)), np.nan)
+        now = time.time()
+        with self._lock:
+            rows = self._loadRows(profile, metric, np.unique(srcIds).tolist())
+            for i, srcId in enumerate(srcIds.tolist()):
+                row = rows.get(srcId)
+                if row is not None:
+                    values[i] = self._match(row, dstIds, now)
+            hitCount = int(np.count_nonzero(~np.isnan(values)))
+            self.hits += hitCount
+            self.misses += values.size - hitCount
+        return values
+
+    def set(self, key, value):
+        self.setMany([(key, value)])
+
+    def setMany(self, items):
+        """ Store (key, value) pairs; NaN values (unreachable pairs) are not cached """
+        items = [(key, value) for key, value in items if value == value]
+        if not items:
+            return
+        ids = self._keyIds([nodeKey for key, _ in items for nodeKey in key[2:]]).tolist()
+        cells = {}
+        for k, ((profile, metric, _, _), value) in enumerate(items):
+            cells.setdefault((profile, metric, ids[2 * k]), {})[ids[2 * k + 1]] = float(value)
+        now = time.time()
+        with self._lock:
+            written, compacted = [], {}
+            for (profile, metric, srcId), values in cells.items():
+                row = self._loadRows(profile, metric, [srcId]).get(srcId)
+                if row is None:
+                    row = [np.empty(0, dtype=np.int64), np.empty(0), np.empty(0), {}]
                 else:
-                    raise ValueError(f"timeUnit '{timeUnit}' not understood.")
-            else:
-                warnings.warn('Fail to get data from the OSRM API, so use the haversine distance here.')
-                timeMatx = []
-                row = []
-                for y in nodeList:
-                    hsDist = hs.haversine((nodeList[0][1],nodeList[0][0]),(y[1],y[0]), unit=hs.Unit.METERS)
-                    if (timeUnit == 'second'):
-                        row.append(hsDist/(speed/3.6))
-                    elif (timeUnit == 'minute'):
-                        row.append((hsDist/(speed/3.6))/60)
-                    elif (timeUnit == 'hour'):
-                        row.append((hsDist/(speed/3.6))/60/60)
-                    else:
-                        raise ValueError(f"timeUnit '{timeUnit}' not understood.")
-                timeMatx.append(row)
-                return np.round(np.array(timeMatx), decimals)
-        
-        elif (get == 'distance'):
-            nodes += f'&annotations={get}'
-            newURL = tableURL + nodes
-            try:
-                r = requests.get(newURL, timeout=timeout)
-            except requests.exceptions.Timeout:
-                warnings.warn('Exceed the maximum timeout to request, so use the haversine distance here.')
-                distMatx = []
-                row = []
-                for y in nodeList:
-                    if (distUnit == 'm'):
-                        row.append(hs.haversine((nodeList[0][1],nodeList[0][0]),(y[1],y[0]), unit=hs.Unit.METERS))
-                    elif (distUnit == 'km'):
-                        row.append(hs.haversine((nodeList[0][1],nodeList[0][0]),(y[1],y[0]), unit=hs.Unit.KILOMETERS))
-                    else:
-                        raise ValueError(f"distUnit '{distUnit}' not understood.")
-                distMatx.append(row)
-                return np.round(np.array(distMatx), decimals)
-            
-            tableInfo = json.loads(r.content)
-            if (tableInfo['code'] == 'Ok'):
-                if (distUnit == 'm'):
-                    return np.array(tableInfo['distances'])
-                elif (distUnit == 'km'):
-                    return np.round(np.array(tableInfo['distances'])/1000, decimals)
+                    self._forget((profile, metric, srcId))     # pending 會被原地修改，先扣除舊的格數
+                row[3].update((dstId, (value, now)) for dstId, value in values.items())
+                if len(row[3]) > max(64, len(row[0]) // 4):
+                    row = self._compact(row)
+                    compacted[(profile, metric, srcId)] = row
                 else:
-                    raise ValueError(f"distUnit '{distUnit}' not understood")
+                    written += [(profile, metric, srcId, dstId, value, now) for dstId, value in values.items()]
+                self._remember((profile, metric, srcId), row)
+            if self._db is not None:
+                self._db.executemany('INSERT OR REPLACE INTO odcell (profile, metric, orign, destn, value, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                                     written)
+                self._writeRows(compacted)
+                self._db.commit()
+
+    def setMatrix(self, profile, metric, orignList, destnList, values):
+        """ Store the `metric` matrix from `orignList` to `destnList`; NaN values (unreachable pairs) are not cached """
+        srcIds, dstIds = self.nodeIds(orignList), self.nodeIds(destnList)
+        values = np.asarray(values, dtype=np.float64).reshape(len(srcIds), len(dstIds))
+        now = time.time()
+        with self._lock:
+            rows = self._loadRows(profile, metric, np.unique(srcIds).tolist())
+            changed = {}
+            for i, srcId in enumerate(srcIds.tolist()):
+                valid = ~np.isnan(values[i])
+                if not valid.any():
+                    continue
+                old = changed.get(srcId, rows.get(srcId))
+                new = (dstIds[valid], values[i][valid], np.full(np.count_nonzero(valid), now))
+                changed[srcId] = self._compact(old, new)
+            for srcId, row in changed.items():
+                self._remember((profile, metric, srcId), row)
+            if (self._db is not None) and changed:
+                self._writeRows({(profile, metric, srcId): row for srcId, row in changed.items()})
+                self._db.commit()
+
+    def clear(self):
+        """ Drop every cached value, e.g. after the OSRM map data has been updated """
+        with self._lock:
+            self._rows.clear()
+            self._cells = 0
+            if self._db is not None:
+                self._db.execute('DELETE FROM odrow')
+                self._db.execute('DELETE FROM odcell')
+                self._db.commit()
+
+    def stats(self):
+        """ Hit/miss statistics of the cache """
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hitRate': self.hits / total if total else 0.0,
+                    'memorySize': self._cells, 'memoryRows': len(self._rows)}
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _compact(self, row, new=None):
+        """ A row with its pending cells, and then the `new` (ids, values, updated) arrays, merged into its sorted arrays """
+        # 依新到舊排列後以 np.unique 取每個 id 第一次出現的位置，使較新的值覆蓋較舊的值
+        parts = [] if new is None else [new]
+        if row is not None:
+            if row[3]:
+                pending = np.array([(value, updated) for value, updated in row[3].values()]).reshape(-1, 2)
+                parts.append((np.fromiter(row[3], dtype=np.int64, count=len(row[3])), pending[:, 0], pending[:, 1]))
+            parts.append(row[:3])
+        ids, vals, updated = (np.concatenate([part[k] for part in parts]) for k in range(3))
+        ids, first = np.unique(ids, return_index=True)
+        return [ids, vals[first], updated[first], {}]
+
+    def _writeRows(self, rows):
+        """ Write the compacted `rows` ({(profile, metric, srcId): row}) to SQLite, replacing their single cells """
+        self._db.executemany('INSERT OR REPLACE INTO odrow (profile, metric, orign, destns, vals, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                             [key + (row[0].tobytes(), row[1].tobytes(), row[2].tobytes()) for key, row in rows.items()])
+        self._db.executemany('DELETE FROM odcell WHERE profile = ? AND metric = ? AND orign = ?', list(rows))
+
+    def _loadRows(self, profile, metric, srcIds):
+        """ The rows of `srcIds` found in memory or in the SQLite file, by origin id """
+        rows, diskIds = {}, []
+        for srcId in srcIds:
+            row = self._rows.get((profile, metric, srcId))
+            if row is None:
+                diskIds.append(srcId)
             else:
-                warnings.warn('Fail to get data from the OSRM API, so use the haversine distance here.')
-                distMatx = []
-                row = []
-                for y in nodeList:
-                    if (distUnit == 'm'):
-                        row.append(hs.haversine((nodeList[0][1],nodeList[0][0]),(y[1],y[0]), unit=hs.Unit.METERS))
-                    elif (distUnit == 'km'):
-                        row.append(hs.haversine((nodeList[0][1],nodeList[0][0]),(y[1],y[0]), unit=hs.Unit.KILOMETERS))
-                    else:
-                        raise ValueError(f"distUnit '{distUnit}' not understood.")
-                distMatx.append(row)
-                return np.round(np.array(distMatx), decimals)
-        
-        elif (get == 'duration;distance') or (get == 'distance;duration'):
-            nodes += f'&annotations={get}'
-            newURL = tableURL + nodes
+                self._rows.move_to_end((profile, metric, srcId))
+                rows[srcId] = row
+        if diskIds and (self._db is not None):
+            found = {}
+            for start in range(0, len(diskIds), 900):    # SQLite 預設最多 999 個參數
+                chunk = diskIds[start:start + 900]
+                where = f'WHERE profile = ? AND metric = ? AND orign IN ({",".join("?" * len(chunk))})'
+                for srcId, ids, vals, updated in self._db.execute(f'SELECT orign, destns, vals, updated FROM odrow {where}',
+                                                                  [profile, metric] + chunk):
+                    found[srcId] = [np.frombuffer(ids, dtype=np.int64), np.frombuffer(vals, dtype=np.float64),
+                                    np.frombuffer(updated, dtype=np.float64), {}]
+                for srcId, dstId, value, updated in self._db.execute(f'SELECT orign, destn, value, updated FROM odcell {where}',
+                                                                     [profile, metric] + chunk):
+                    row = found.setdefault(srcId, [np.empty(0, dtype=np.int64), np.empty(0), np.empty(0), {}])
+                    row[3][dstId] = (value, updated)
+            for srcId, row in found.items():
+                self._remember((profile, metric, srcId), row)
+                rows[srcId] = row
+        return rows
+
+    def _match(self, row, dstIds, now):
+        """ The values of `dstIds` in `row`, NaN where missing or expired """
+        ids, vals, updated, pending = row
+        values = np.full(len(dstIds), np.nan)
+        if len(ids):
+            pos = np.minimum(np.searchsorted(ids, dstIds), len(ids) - 1)
+            found = ids[pos] == dstIds
+            if self.ttl is not None:
+                found &= (now - updated[pos]) <= self.ttl
+            values = np.where(found, vals[pos], np.nan)
+        if pending and (len(dstIds) <= 8):
+            # 少量查詢（例如 route()）直接查 dict，不必為可能很大的 pending 建立陣列
+            for k, dstId in enumerate(dstIds.tolist()):
+                cell = pending.get(dstId)
+                if (cell is not None) and ((self.ttl is None) or (now - cell[1] <= self.ttl)):
+                    values[k] = cell[0]
+        elif pending:
+            pendingIds = np.fromiter(pending, dtype=np.int64, count=len(pending))
+            cells = np.array(list(pending.values())).reshape(-1, 2)
+            order = np.argsort(pendingIds)
+            pendingIds, cells = pendingIds[order], cells[order]
+            pos = np.minimum(np.searchsorted(pendingIds, dstIds), len(pendingIds) - 1)
+            found = pendingIds[pos] == dstIds
+            if self.ttl is not None:
+                found &= (now - cells[pos, 1]) <= self.ttl
+            values = np.where(found, cells[pos, 0], values)
+        return values
+
+    def _forget(self, key):
+        row = self._rows.pop(key, None)
+        if row is not None:
+            self._cells -= len(row[0]) + len(row[3])
+
+    def _remember(self, key, row):
+        self._forget(key)
+        self._rows[key] = row
+        self._cells += len(row[0]) + len(row[3])
+        while (self._cells > self.maxSize) and (len(self._rows) > 1):
+            evicted = self._rows.popitem(last=False)[1]
+            self._cells -= len(evicted[0]) + len(evicted[3])
+
+
+class HintCache:
+    """ Bounded LRU of the OSRM waypoint hints per coordinate, cleared whenever the server's data checksum changes """
+
+    # 尚未快取任何 hint 時預估的 hint 長度（OSRM 5.x 的 hint 約 110 個字元）
+    typicalLength = 128
+
+    def __init__(self, maxSize=100000, precision=5):
+        # hint 是 OSRM 將座標對應到路網後的結果，再次送出可省去伺服器端的對應計算；
+        # hint 最後 4 個位元組為地圖資料的 checksum，伺服器更新資料後舊的 hint 便失效
+        self.maxSize = maxSize
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.checksums = {}     # profile -> 目前資料的 checksum
+        self._longest = {}      # profile -> 曾快取的最長 hint 長度
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, profile, node):
+        return f'{profile}|{node[0]:.{self.precision}f},{node[1]:.{self.precision}f}'
+
+    def getMany(self, profile, nodes, record=True):
+        """ The cached hints of `nodes`, with '' for every miss; record=False leaves the statistics and LRU order untouched """
+        hints = []
+        with self._lock:
+            for node in nodes:
+                key = self.key(profile, node)
+                hint = self._memory.get(key)
+                if not record:
+                    hints.append(hint or '')
+                elif hint is None:
+                    self.misses += 1
+                    hints.append('')
+                else:
+                    self.hits += 1
+                    self._memory.move_to_end(key)
+                    hints.append(hint)
+        return hints
+
+    def setMany(self, profile, nodes, hints):
+        """ Store the `hints` returned for `nodes`, dropping every hint of `profile` if the data checksum has changed """
+        hints = [(node, hint) for node, hint in zip(nodes, hints) if hint]
+        if not hints:
+            return
+        checksum = _hintChecksum(hints[-1][1])
+        with self._lock:
+            if checksum != self.checksums.get(profile, checksum):
+                self.invalidations += 1
+                prefix = f'{profile}|'
+                for key in [key for key in self._memory if key.startswith(prefix)]:
+                    del self._memory[key]
+                self._longest.pop(profile, None)
+            self.checksums[profile] = checksum
+            self._longest[profile] = max([self._longest.get(profile, 0)] + [len(hint) for _, hint in hints])
+            for node, hint in hints:
+                key = self.key(profile, node)
+                self._memory[key] = hint
+                self._memory.move_to_end(key)
+            while len(self._memory) > self.maxSize:
+                self._memory.popitem(last=False)
+
+    def longest(self, profile):
+        """ The length of the longest hint of `profile` cached so far, or `typicalLength` if none is cached yet """
+        with self._lock:
+            return self._longest.get(profile, self.typicalLength)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self.checksums.clear()
+            self._longest.clear()
+
+    def stats(self):
+        """ Hit/miss statistics of the cache """
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hitRate': self.hits / total if total else 0.0,
+                    'invalidations': self.invalidations, 'memorySize': len(self._memory)}
+
+
+def _hintChecksum(hint):
+    """ The data checksum stored in the last 4 bytes of an OSRM hint (URL-safe base64), or None if it cannot be decoded """
+    try:
+        data = base64.b64decode(hint + '=' * (-len(hint) % 4), altchars=b'-_', validate=True)
+    except (ValueError, TypeError):
+        return None
+    return int.from_bytes(data[-4:], 'little') if len(data) >= 4 else None
+
+_HINT = re.compile(rb'"hint":"([^"]*)"')
+
+def _waypointHints(content, name, count):
+    """ The hints of the first `count` waypoints of the `name` ('sources' or 'destinations') array of a raw /table response """
+    # 直接在原始 bytes 中搜尋，不需解析整個回應；每個 waypoint 恰有一個 hint
+    if isinstance(content, dict):
+        return [waypoint.get('hint') for waypoint in content.get(name, [])[:count]]
+    start = content.find(b'"' + name.encode() + b'":[')
+    if start < 0:
+        return []
+    return [match.group(1).decode() for match in itertools.islice(_HINT.finditer(content, start), count)]
+
+
+class CircuitBreaker:
+    """ Skip the OSRM API for `cooldown` seconds after `threshold` consecutive failed requests (timeouts, connection errors or non-Ok codes) """
+
+    def __init__(self, threshold=5, cooldown=30, probes=1):
+        # 冷卻結束後進入 half-open，只放行 `probes` 個探測請求，成功即恢復、失敗則再次開啟
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probes = probes
+        self.state = 'closed'
+        self.failures = 0
+        self._openedAt = 0.0
+        self._probing = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Whether a request may be sent now """
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open':
+                if time.monotonic() - self._openedAt < self.cooldown:
+                    return False
+                self.state = 'halfOpen'
+                self._probing = 0
+            if self._probing < self.probes:
+                self._probing += 1
+                return True
+            return False
+
+    def recordSuccess(self):
+        with self._lock:
+            self.failures = 0
+            self.state = 'closed'
+
+    def recordFailure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == 'halfOpen') or (self.failures >= self.threshold):
+                self.state = 'open'
+                self._openedAt = time.monotonic()
+
+
+class AdaptiveTimeout:
+    """ Request timeout following a percentile of the recently observed latencies """
+
+    def __init__(self, initial=5, percentile=99, multiplier=3, minimum=0.5, maximum=30, window=200, warmup=20):
+        # 樣本數少於 warmup 時固定使用 initial；latency 以 size（請求大小）正規化，使大小不同的 /table 請求可共用
+        # 請求比近期樣本中最大者大上 2 倍以上時，固定成本與每格成本的比例無法由小請求外推，逾時不低於 initial
+        self.initial = initial
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.minimum = minimum
+        self.maximum = maximum
+        self.warmup = warmup
+        self._samples = deque(maxlen=window)
+        self._sizes = deque(maxlen=window)
+        self._value = None
+        self._largest = 0
+        self._lock = threading.Lock()
+
+    def observe(self, latency, size=1):
+        with self._lock:
+            self._samples.append(latency / size)
+            self._sizes.append(size)
+            self._value = None
+
+    def observeTimeout(self, timeout, size=1):
+        """ Count a request that timed out after `timeout` seconds, so that the timeout grows while the server is slower than expected """
+        # 逾時的請求至少花了 timeout 秒；若只記錄成功的延遲，伺服器變慢後逾時值會停在舊的估計而一直逾時
+        with self._lock:
+            self._samples.append(min(timeout, self.maximum) / size)
+            self._sizes.append(size)
+            self._value = None
+
+    def get(self, size=1):
+        """ The timeout (s) of a request of `size` """
+        with self._lock:
+            if len(self._samples) < self.warmup:
+                return self.initial
+            if self._value is None:
+                self._value = float(np.percentile(self._samples, self.percentile)) * self.multiplier
+                self._largest = max(self._sizes)
+            value, largest = self._value, self._largest
+        timeout = min(max(value * size, self.minimum), self.maximum * size)
+        if size > 2 * largest:
+            timeout = max(timeout, self.initial)
+        return timeout
+
+
+class _Backend:
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.outstanding = 0
+        self.latency = None                 # 指數加權移動平均（秒）
+        self.samples = deque(maxlen=200)
+        self.failures = 0
+        self.downUntil = 0.0
+
+
+class BackendPool:
+    """ Several OSRM servers behind one client, with load balancing, passive health checks, failover and hedging """
+
+    def __init__(self, urls, strategy='leastOutstanding', threshold=3, cooldown=10, hedge=False, hedgeQuantile=95, workers=32):
+        # strategy: 'leastOutstanding'（進行中請求最少者優先）或 'latency'（延遲 x 進行中請求數最小者優先）
+        # 連續 threshold 次逾時、連線失敗或 5xx 的伺服器在 cooldown 秒內只作為最後手段
+        # hedge=True 時，若第一台伺服器在其延遲的 hedgeQuantile 百分位內尚未回應，便同時向第二台送出相同請求
+        if strategy not in ('leastOutstanding', 'latency'):
+            raise ValueError(f"strategy '{strategy}' not understood.")
+        self.backends = [_Backend(url) for url in ([urls] if isinstance(urls, str) else urls)]
+        self.strategy = strategy
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.hedge = hedge
+        self.hedgeQuantile = hedgeQuantile
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def urls(self):
+        return [backend.url for backend in self.backends]
+
+    def order(self):
+        """ Backends in the order they should be tried: healthy ones by score, then the unhealthy ones """
+        now = time.monotonic()
+        with self._lock:
+            healthy = [backend for backend in self.backends if backend.downUntil <= now]
+            unhealthy = sorted((backend for backend in self.backends if backend.downUntil > now), key=lambda backend: backend.downUntil)
+            return sorted(healthy, key=self._score) + unhealthy
+
+    def fetch(self, session, path, timeout):
+        """ GET `path` (e.g. '/route/v1/driving/...') and return the response body, failing over across the backends """
+        backends = self.order()
+        error = None
+        while backends:
+            backend = backends.pop(0)
             try:
-                r = requests.get(newURL, timeout=timeout)
-            except requests.exceptions.Timeout:
-                warnings.warn('Exceed the maximum timeout to request, so use the haversine distance here.')
-                timeMatx, distMatx = [], []
-                timeRow, distRow = [], []
-                for y in nodeList:
-                    hsDist = hs.haversine((nodeList[0][1],nodeList[0][0]),(y[1],y[0]), unit=hs.Unit.METERS)
-                    if (timeUnit == 'second'):
-                        timeRow.append(hsDist/(speed/3.6))
-                    elif (timeUnit == 'minute'):
-                        timeRow.append((hsDist/(speed/3.6))/60)
-                    elif (timeUnit == 'hour'):
-                        timeRow.append((hsDist/(speed/3.6))/60/60)
-                    else:
-                        raise ValueError(f"timeUnit '{timeUnit}' not understood.")
-                    
-                    if (distUnit == 'm'):
-                        distRow.append(hsDist)
-                    elif (distUnit == 'km'):
-                        distRow.append(hsDist/1000)
-                    else:
-                        raise ValueError(f"distUnit '{distUnit}' not understood.")
-                timeMatx.append(timeRow)
-                distMatx.append(distRow)
-                return np.round(np.array(timeMatx), decimals), np.round(np.array(distMatx), decimals)
-
-            tableInfo = json.loads(r.content)
-            if (tableInfo['code'] == 'Ok'):
-                if (timeUnit == 'second'):
-                    timeMatx = np.array(tableInfo['durations'])
-                elif (timeUnit == 'minute'):
-                    timeMatx = np.array(tableInfo['durations']) / 60
-                elif (timeUnit == 'hour'):
-                    timeMatx = np.array(tableInfo['durations']) / 60 / 60
+                if self.hedge and backends:
+                    return self._hedged(session, path, timeout, backend, backends)
+                return self._get(session, backend, path, timeout)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as e:
+                error = e
+        raise error
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def _score(self, backend):
+        latency = backend.latency if backend.latency is not None else 0.0
+        if self.strategy == 'latency':
+            return latency * (backend.outstanding + 1), backend.outstanding
+        return backend.outstanding, latency
+
+    def _get(self, session, backend, path, timeout):
+        with self._lock:
+            backend.outstanding += 1
+        start = time.monotonic()
+        ok = False
+        try:
+            r = session.get(backend.url + path, timeout=timeout)
+            if r.status_code >= 500:
+                raise requests.exceptions.HTTPError(f'{r.status_code} Server Error for url: {r.url}', response=r)
+            ok = True
+            return r.content
+        finally:
+            self._record(backend, time.monotonic() - start, ok)
+
+    def _record(self, backend, latency, ok):
+        with self._lock:
+            backend.outstanding -= 1
+            if ok:
+                backend.failures = 0
+                backend.downUntil = 0.0
+                backend.samples.append(latency)
+                backend.latency = latency if backend.latency is None else 0.8 * backend.latency + 0.2 * latency
+            else:
+                backend.failures += 1
+                if backend.failures >= self.threshold:
+                    backend.downUntil = time.monotonic() + self.cooldown
+
+    def _hedged(self, session, path, timeout, primary, backends):
+        """ GET `path` from `primary`, hedging with the next of `backends` (removed from the list once used) if it is slow """
+        # 第一台在送出備援請求前就失敗時直接拋出，由 fetch 改送下一台（仍留在 backends 中）
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            samples = list(primary.samples)
+        first = self._executor.submit(self._get, session, primary, path, timeout)
+        if len(samples) < 20:
+            return first.result()
+        try:
+            return first.result(timeout=float(np.percentile(samples, self.hedgeQuantile)))
+        except FutureTimeoutError:
+            pass
+
+        # 第一個請求逾時未回應，送出備援請求，取先成功者
+        pending = {first, self._executor.submit(self._get, session, backends.pop(0), path, timeout)}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as e:
+                    error = e
+        raise error
+
+
+class ClientStats:
+    """ Request, fallback and latency statistics of an OSRMClient, with callbacks for exporting them to a monitoring system """
+
+    # 延遲直方圖各桶的上界（秒），最後一桶為無上限
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = Counter()          # 各入口（distance, odMatrix, ...）的呼叫次數
+            self.requests = Counter()       # 各 service（route, table）送出的 HTTP 請求數
+            self.outcomes = Counter()       # 請求結果：OSRM 回傳的 code、'timeout' 或 'error'
+            self.responseBytes = Counter()  # 各 service 收到的回應大小
+            self.longestURL = Counter()     # 各 service 送出的最長 URL 長度
+            self.fallbacks = Counter()      # 改用 haversine 的原因：'timeout', 'error', 'code', 'circuit'
+            self.values = Counter()         # 回傳值的來源：'osrm', 'cache', 'haversine'
+            self.coalesced = Counter()      # 合併查詢：'batches' 批次數、'lookups' 批次內的查詢數、'shared' 共用進行中請求的查詢數
+            self.histograms = {}            # 'network.table', 'decode.route', 'post.odMatrix', ... 的延遲直方圖
+
+    def subscribe(self, callback):
+        """ Call `callback(event, fields)` on every recorded event """
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        self._callbacks.remove(callback)
+
+    def record(self, event, **fields):
+        """ Count one event ('call', 'url', 'request', 'fallback', 'decode', 'post', 'values' or 'coalesce') and pass it on to the callbacks """
+        with self._lock:
+            if event == 'call':
+                self.calls[fields['name']] += 1
+            elif event == 'url':
+                self.longestURL[fields['service']] = max(self.longestURL[fields['service']], fields['length'])
+            elif event == 'request':
+                self.requests[fields['service']] += 1
+                self.outcomes[fields['outcome']] += 1
+                self.responseBytes[fields['service']] += fields['bytes']
+                self._observe(f"network.{fields['service']}", fields['seconds'])
+            elif event == 'fallback':
+                self.fallbacks[fields['reason']] += 1
+            elif event in ('decode', 'post'):
+                self._observe(f"{event}.{fields['name']}", fields['seconds'])
+            elif event == 'values':
+                self.values[fields['source']] += fields['count']
+            elif event == 'coalesce':
+                if fields['kind'] == 'batch':
+                    self.coalesced['batches'] += 1
+                    self.coalesced['lookups'] += fields['size']
                 else:
-                    raise ValueError(f"timeUnit '{timeUnit}' not understood")
-                
-                if (distUnit == 'm'):
-                    distMatx = np.array(tableInfo['distances'])
-                elif (distUnit == 'km'):
-                    distMatx = np.array(tableInfo['distances']) / 1000
+                    self.coalesced['shared'] += 1
+        for callback in self._callbacks:
+            callback(event, fields)
+
+    def snapshot(self):
+        """ A JSON-serialisable copy of all statistics """
+        with self._lock:
+            return {'calls': dict(self.calls), 'requests': dict(self.requests), 'outcomes': dict(self.outcomes),
+                    'responseBytes': dict(self.responseBytes), 'longestURL': dict(self.longestURL), 'fallbacks': dict(self.fallbacks),
+                    'values': dict(self.values), 'coalesced': dict(self.coalesced), 'buckets': list(self.BUCKETS),
+                    'histograms': {name: dict(hist, counts=list(hist['counts'])) for name, hist in self.histograms.items()}}
+
+    def _observe(self, name, seconds):
+        hist = self.histograms.get(name)
+        if hist is None:
+            hist = self.histograms[name] = {'counts': [0] * (len(self.BUCKETS) + 1), 'count': 0, 'sum': 0.0}
+        hist['counts'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        hist['count'] += 1
+        hist['sum'] += seconds
+
+
+class _Coalescer:
+    """ Merge the concurrent point lookups of an OSRMClient: identical ones share a request, the others arriving within `window` seconds share /table requests """
+
+    # 一批查詢依起訖點排序後切成多個 /table 請求，每個請求的格數最多為其 pair 數的 cellsPerPair 倍
+    cellsPerPair = 10
+
+    def __init__(self, client, window, maxBatch):
+        # 批次中第一個查詢的執行緒（leader）等待 window 秒後送出整批；批次滿 maxBatch 個時由加入最後一個的執行緒立即送出
+        self.client = client
+        self.window = window
+        self.maxBatch = maxBatch
+        self._inflight = {}
+        self._batch = []
+        self._lock = threading.Lock()
+
+    def lookup(self, orign, destn, timeout, speed):
+        """ The Route from `orign` to `destn`, shared with identical lookups in flight """
+        key = (tuple(orign), tuple(destn), speed)
+        with self._lock:
+            future = self._inflight.get(key)
+            shared = future is not None
+            if not shared:
+                future = self._inflight[key] = Future()
+                batch = self._batch
+                batch.append((key, future, timeout))
+                leader, full = (len(batch) == 1), (len(batch) >= self.maxBatch)
+                if full:
+                    self._batch = []
+        if shared:
+            self.client.stats.record('coalesce', kind='shared')
+            return future.result()
+        if leader and not full:
+            time.sleep(self.window)
+            with self._lock:
+                full = batch is self._batch
+                if full:
+                    self._batch = []
+        if full:
+            self._run(batch)
+        return future.result()
+
+    def _run(self, batch):
+        self.client.stats.record('coalesce', kind='batch', size=len(batch))
+        groups = {}
+        for key, future, timeout in batch:
+            groups.setdefault((timeout, key[2]), []).append((key, future))
+        for (timeout, speed), items in groups.items():
+            srcId = np.unique(np.array([key[0] for key, _ in items]), axis=0, return_inverse=True)[1].ravel()
+            dstId = np.unique(np.array([key[1] for key, _ in items]), axis=0, return_inverse=True)[1].ravel()
+            order = np.lexsort((dstId, srcId))
+            for group in _groupPairs(srcId[order], dstId[order], self.maxBatch, self.cellsPerPair):
+                part = [items[k] for k in order[group].tolist()]
+                # 錯誤交給該組每個查詢各自拋出，並繼續處理其他組，避免有查詢永遠等不到結果
+                try:
+                    routes = self._routes([key[0] for key, _ in part], [key[1] for key, _ in part], timeout, speed)
+                except BaseException as e:
+                    self._finish(part, [None] * len(part), e)
                 else:
-                    raise ValueError(f"distUnit '{distUnit}' not understood")
-                return np.round(np.array(timeMatx), decimals), np.round(np.array(distMatx), decimals)
+                    self._finish(part, routes)
+
+    def _finish(self, items, routes, error=None):
+        with self._lock:
+            for key, _ in items:
+                self._inflight.pop(key, None)
+        for (_, future), route in zip(items, routes):
+            if error is None:
+                future.set_result(route)
             else:
-                warnings.warn('Fail to get data from the OSRM API, so use the haversine distance instead.')
-                timeMatx, distMatx = [], []
-                timeRow, distRow = [], []
-                for y in nodeList:
-                    hsDist = hs.haversine((nodeList[0][1],nodeList[0][0]),(y[1],y[0]), unit=hs.Unit.METERS)
-                    if (timeUnit == 'second'):
-                        timeRow.append(hsDist/(speed/3.6))
-                    elif (timeUnit == 'minute'):
-                        timeRow.append((hsDist/(speed/3.6))/60)
-                    elif (timeUnit == 'hour'):
-                        timeRow.append((hsDist/(speed/3.6))/60/60)
-                    else:
-                        raise ValueError(f"timeUnit '{timeUnit}' not understood.")
-                    
-                    if (distUnit == 'm'):
-                        distRow.append(hsDist)
-                    elif (distUnit == 'km'):
-                        distRow.append(hsDist/1000)
-                    else:
-                        raise ValueError(f"distUnit '{distUnit}' not understood.")
-                timeMatx.append(timeRow)
-                distMatx.append(distRow)
-                return np.round(np.array(timeMatx), decimals), np.round(np.array(distMatx), decimals)
-        else:
-            raise ValueError(f"get '{get}' not understood.")
-    
-    else:
-        # 依據 get 參數決定回傳的值
-        if (get == 'duration'):
-            nodes += f'?annotations={get}'
-            newURL = tableURL + nodes            
-            try:
-                r = requests.get(newURL, timeout=timeout)
-            except requests.exceptions.Timeout:
-                warnings.warn('Exceed the maximum timeout to request, so use the haversine distance instead.')
-                timeMatx = []
-                for x in nodeList:
-                    row = []
-                    for y in nodeList:
-                        hsDist = hs.haversine((x[1],x[0]),(y[1],y[0]), unit=hs.Unit.METERS)
-                        if (timeUnit == 'second'):
-                            row.append(hsDist/(speed/3.6))
-                        elif (timeUnit == 'minute'):
-                            row.append((hsDist/(speed/3.6))/60)
-                        elif (timeUnit == 'hour'):
-                            row.append((hsDist/(speed/3.6))/60/60)
-                        else:
-                            raise ValueError(f"timeUnit '{timeUnit}' not understood.")
-                    timeMatx.append(row)
-                return np.round(np.array(timeMatx), decimals)
-            
-            tableInfo = json.loads(r.content)
-            if (tableInfo['code'] == 'Ok'):
-                if (timeUnit == 'second'):
-                    return np.array(tableInfo['durations'])
-                elif (timeUnit == 'minute'):
-                    return np.round(np.array(tableInfo['durations'])/60, decimals)
-                elif (timeUnit == 'hour'):
-                    return np.round(np.array(tableInfo['durations'])/60/60, decimals)
-                else:
-                    raise ValueError(f"timeUnit '{timeUnit}' not understood.")
+                future.set_exception(error)
+
+    def _routes(self, orignList, destnList, timeout, speed):
+        """ The Routes of the (orign, destn) pairs, from one table of their distinct origins and destinations """
+        orignArr, destnArr = np.array(orignList, dtype=np.float64), np.array(destnList, dtype=np.float64)
+        srcNodes, srcPos = np.unique(orignArr, axis=0, return_inverse=True)
+        dstNodes, dstPos = np.unique(destnArr, axis=0, return_inverse=True)
+        nodeArr = np.concatenate([srcNodes, dstNodes])
+        srcIdx, dstIdx = np.arange(len(srcNodes)), len(srcNodes) + np.arange(len(dstNodes))
+        metrics = ('duration', 'distance')
+        matrices = {metric: np.empty((len(srcNodes), len(dstNodes))) for metric in metrics}
+        mask = np.empty((len(srcNodes), len(dstNodes)), dtype=bool)
+        fill = self.client._fillMatrices if self.client.cache is None else self.client._fillFromCache
+        fill(nodeArr, srcIdx, dstIdx, matrices, metrics, timeout, speed, None, 1, mask)
+
+        routes = []
+        for orign, destn, i, j in zip(orignList, destnList, srcPos.ravel().tolist(), dstPos.ravel().tolist()):
+            duration, distance = float(matrices['duration'][i, j]), float(matrices['distance'][i, j])
+            if mask[i, j] and (duration == duration) and (distance == distance):
+                routes.append(Route(distance, duration, '', None, 'osrm'))
             else:
-                warnings.warn('Fail to get data from the OSRM API, so use the haversine distance instead.')
-                timeMatx = []
-                for x in nodeList:
-                    row = []
-                    for y in nodeList:
-                        hsDist = hs.haversine((x[1],x[0]),(y[1],y[0]), unit=hs.Unit.METERS)
-                        if (timeUnit == 'second'):
-                            row.append(hsDist/(speed/3.6))
-                        elif (timeUnit == 'minute'):
-                            row.append((hsDist/(speed/3.6))/60)
-                        elif (timeUnit == 'hour'):
-                            row.append((hsDist/(speed/3.6))/60/60)
-                        else:
-                            raise ValueError(f"timeUnit '{timeUnit}' not understood.")
-                    timeMatx.append(row)
-                return np.round(np.array(timeMatx), decimals)
-        
-        elif (get == 'distance'):
-            nodes += f'?annotations={get}'
-            newURL = tableURL + nodes
+                # 無法到達（null）的格子與 /route 回傳非 Ok 時相同，改用 haversine 備援；整塊失敗的已在 _request 記錄過
+                if mask[i, j]:
+                    self.client.stats.record('fallback', service='table', reason='code')
+                routes.append(_fallbackRoute(orign, destn, speed))
+        return routes
+
+
+class OSRMClient:
+    """ OSRM client which reuses pooled keep-alive HTTP connections across requests """
+
+    def __init__(self, baseURL=baseURL, profile='driving', poolSize=10, keepAlive=True, retries=2, backoff=0.1, cache=None, memoTTL=1.0,
+                 breaker=None, stats=None, hints=None, encoding='plain', precision=None, maxURLLength=None,
+                 coalesceWindow=None, coalesceBatch=100):
+        # baseURL: 'http://host:port'、多個 URL 組成的 list，或 BackendPool；profile: 'driving', 'car', 'bike', 'foot', ...
+        # cache: ODCache，快取 OSRM 成功回傳的結果（haversine 備援值不會被快取）
+        # memoTTL: route() 結果的短期暫存秒數，讓接連呼叫 distance() 與 travTime() 只發一次請求
+        self.backends = baseURL if isinstance(baseURL, BackendPool) else BackendPool(baseURL)
+        self.baseURL = self.backends.urls[0]
+        self.profile = profile
+        self.poolSize = poolSize
+        self.cache = cache
+        self.memoTTL = memoTTL
+        self._memo = {}
+        self._memoLock = threading.Lock()
+        # breaker: 所有方法共用的 CircuitBreaker；各方法的 timeout=None 時使用依延遲分布調整的 AdaptiveTimeout
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+        self.timeouts = {'route': AdaptiveTimeout(), 'table': AdaptiveTimeout()}
+        # stats: ClientStats，記錄請求數、延遲、回應大小與備援原因；可在多個 client 間共用
+        self.stats = ClientStats() if stats is None else stats
+        # hints: HintCache，保存各座標的 waypoint hint 並在之後的請求中以 hints 參數送出
+        self.hints = hints
+        # encoding: 座標的編碼，'plain'、'polyline' 或 'polyline6'；precision: 'plain' 座標的小數位數，None 表示完整精度
+        # maxURLLength: URL 長度上限（例如代理伺服器的限制），odMatrix 未指定 tileSize 時依此切塊，distSeq 依此分段
+        _formatCoordinates([], encoding)
+        self.encoding = encoding
+        self.precision = precision
+        self.maxURLLength = maxURLLength
+        # coalesceWindow: 設定後，同時進行的相同查詢只發一次請求，coalesceWindow 秒內的其他 distance / travTime / route
+        # 查詢（最多 coalesceBatch 個）合併成一次 /table 請求；None 表示不合併
+        self.coalescer = None if coalesceWindow is None else _Coalescer(self, coalesceWindow, coalesceBatch)
+
+        # 只重試連線失敗與 5xx 回應；讀取逾時直接交給 haversine 備援處理，避免等待時間倍增
+        retry = Retry(total=retries, connect=retries, read=False, status=retries,
+                      backoff_factor=backoff, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(['GET']), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if not keepAlive:
+            self.session.headers['Connection'] = 'close'
+
+    def close(self):
+        """ Close all pooled connections """
+        self.session.close()
+        self.backends.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    async def distanceMany(self, pairs, unit='m', timeout=None, concurrency=None):
+        """ Get the distances of all (orign, destn) pairs in `pairs` concurrently """
+        self.stats.record('call', name='distanceMany')
+        scale = _unitScale(_DIST_UNITS, unit, 'unit')
+        routes = await self._gatherMany(pairs, concurrency, timeout=timeout)
+        return np.array([route.distance for route in routes], dtype=float) / scale
+
+    async def travTimeMany(self, pairs, unit='second', timeout=None, speed=30, concurrency=None):
+        """ Get the travel times of all (orign, destn) pairs in `pairs` concurrently """
+        self.stats.record('call', name='travTimeMany')
+        scale = _unitScale(_TIME_UNITS, unit, 'unit')
+        routes = await self._gatherMany(pairs, concurrency, timeout=timeout, speed=speed)
+        return np.array([route.duration for route in routes], dtype=float) / scale
+
+    async def _gatherMany(self, pairs, concurrency, **kwargs):
+        # 每個 pair 仍走同步的 _route（含 haversine 備援），由 semaphore 限制同時進行的請求數；
+        # concurrency 預設等於連線池大小，超過時多出的連線無法重複使用
+        concurrency = concurrency or self.poolSize
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(concurrency)
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        async def fetch(orign, destn):
+            async with semaphore:
+                return await loop.run_in_executor(executor, partial(self._route, orign, destn, **kwargs))
+
+        try:
+            return await asyncio.gather(*(fetch(orign, destn) for orign, destn in pairs))
+        finally:
+            executor.shutdown(wait=False)
+
+    def route(self, orign, destn, steps='false', geometry=False, timeout=None, speed=30):
+        """ Get the distance (m), travel time (s) and summary between `orign` and `destn` from one request """
+        # geometry=True 時另外回傳完整路線的 polyline 字串
+        # 同一組起訖點在 memoTTL 秒內重複查詢時直接回傳上次的結果
+        # 回傳的 Route.source 標示此結果來自 OSRM ('osrm') 或 haversine 備援 ('haversine')
+        self.stats.record('call', name='route')
+        return self._route(orign, destn, steps, geometry, timeout, speed)
+
+    def _route(self, orign, destn, steps='false', geometry=False, timeout=None, speed=30):
+        memoKey = (tuple(orign), tuple(destn), steps, geometry)
+        with self._memoLock:
+            memo = self._memo.get(memoKey)
+        if (memo is not None) and (memo[0] > time.monotonic()):
+            self.stats.record('values', source='cache', count=1)
+            return memo[1]
+        if (steps == 'false') and (not geometry) and (self.cache is not None):
+            cached = self.cache.getMany([self.cache.key(self.profile, orign, destn, metric) for metric in ('distance', 'duration')])
+            if None not in cached:
+                self.stats.record('values', source='cache', count=1)
+                return Route(cached[0], cached[1], '', None, 'osrm')
+        if (steps == 'false') and (not geometry) and (self.coalescer is not None):
+            route = self.coalescer.lookup(orign, destn, timeout, speed)
+            if route.source == 'osrm':
+                self._remember(memoKey, route)
+            return route
+
+        query = self._coordinates([orign, destn]) + f'?steps={steps}'
+        query += '&overview=full' if geometry else '&overview=false'
+        query += self._hintQuery([orign, destn])
+        routeInfo = self._request('route', query, timeout)
+        if routeInfo is None:
+            self.stats.record('values', source='haversine', count=1)
+            return _fallbackRoute(orign, destn, speed)
+        self._storeHints([orign, destn], [waypoint.get('hint') for waypoint in routeInfo.get('waypoints', [])])
+        self.stats.record('values', source='osrm', count=1)
+        leg = routeInfo['routes'][0]['legs'][0]
+        route = Route(leg['distance'], leg['duration'], leg['summary'], routeInfo['routes'][0].get('geometry'), 'osrm')
+        self._storeLeg(orign, destn, leg)
+        self._remember(memoKey, route)
+        return route
+
+    def distance(self, orign, destn, unit='m', steps='false', timeout=None):
+        """ Get the distance between `orign` and `destn` """
+        self.stats.record('call', name='distance')
+        scale = _unitScale(_DIST_UNITS, unit, 'unit')
+        route = self._route(orign, destn, steps=steps, timeout=timeout)
+        if (steps == 'true') and (route.source == 'osrm'):
+            return route.distance / scale, route.summary
+        return route.distance / scale
+
+    def travTime(self, orign, destn, unit='second', steps='false', timeout=None, speed=30):
+        """ Get the travel time between `orign` and `destn` """
+        self.stats.record('call', name='travTime')
+        scale = _unitScale(_TIME_UNITS, unit, 'unit')
+        route = self._route(orign, destn, steps=steps, timeout=timeout, speed=speed)
+        if (steps == 'true') and (route.source == 'osrm'):
+            return route.duration / scale, route.summary
+        return route.duration / scale
+
+    def _request(self, service, query, timeout, size=1, raw=False):
+        """ GET `query` from the `service` of the backends and return the decoded OSRM response, or None if the haversine fallback should be used """
+        # query: 座標與參數，例如 '121.5,25.0;121.6,25.1?steps=false'
+        # raw=True 時若回應為 Ok 則直接回傳原始 bytes，交由 _decodeTable 分段解析
+        if not self.breaker.allow():
+            self.stats.record('fallback', service=service, reason='circuit')
+            warnings.warn('The OSRM API keeps failing, so use the haversine distance instead.')
+            return None
+        if timeout is None:
+            timeout = self.timeouts[service].get(size)
+            if self.breaker.state == 'halfOpen':
+                # 探測請求不沿用可能已過短的逾時，以免伺服器恢復後探測仍然逾時而一直無法關閉斷路器
+                timeout = max(timeout, self.timeouts[service].initial)
+        # 任何失敗（逾時、連線錯誤、非 Ok 的 code、無法解析的回應）都改用 haversine，並在 finally 中記錄到斷路器，
+        # 避免探測請求因其他例外離開時斷路器一直停在 half-open
+        succeeded = False
+        start = time.monotonic()
+        try:
             try:
-                r = requests.get(newURL, timeout=timeout)
+                path = f'/{service}/v1/{self.profile}/{query}'
+                self.stats.record('url', service=service, length=len(self.baseURL) + len(path))
+                content = self.backends.fetch(self.session, path, timeout)
             except requests.exceptions.Timeout:
+                self.timeouts[service].observeTimeout(timeout, size)
+                self.stats.record('request', service=service, outcome='timeout', seconds=time.monotonic() - start, bytes=0)
+                self.stats.record('fallback', service=service, reason='timeout')
                 warnings.warn('Exceed the maximum timeout to request, so use the haversine distance instead.')
-                distMatx = []
-                for x in nodeList:
-                    row = []
-                    for y in nodeList:
-                        if (distUnit == 'm'):
-                            row.append(hs.haversine((x[1],x[0]),(y[1],y[0]), unit=hs.Unit.METERS))
-                        elif (distUnit == 'km'):
-                            row.append(hs.haversine((x[1],x[0]),(y[1],y[0]), unit=hs.Unit.KILOMETERS))
-                        else:
-                            raise ValueError(f"distUnit '{distUnit}' not understood.")
-                    distMatx.append(row)
-                return np.round(np.array(distMatx), decimals)
-
-            tableInfo = json.loads(r.content)
-            if (tableInfo['code'] == 'Ok'):
-                if (distUnit == 'm'):
-                    return np.array(tableInfo['distances'])
-                elif (distUnit == 'km'):
-                    return np.round(np.array(tableInfo['distances'])/1000, decimals)
-                else:
-                    raise ValueError(f"distUnit '{distUnit}' not understood.")
-            else:
-                warnings.warn('Fail to get data from the OSRM API, so use the haversine distance instead.')
-                distMatx = []
-                for x in nodeList:
-                    row = []
-                    for y in nodeList:
-                        if (distUnit == 'm'):
-                            row.append(hs.haversine((x[1],x[0]),(y[1],y[0]), unit=hs.Unit.METERS))
-                        elif (distUnit == 'km'):
-                            row.append(hs.haversine((x[1],x[0]),(y[1],y[0]), unit=hs.Unit.KILOMETERS))
-                        else:
-                            raise ValueError(f"distUnit '{distUnit}' not understood.")
-                    distMatx.append(row)
-                return np.round(np.array(distMatx), decimals)
-        
-        elif (get == 'duration;distance') or (get == 'distance;duration'):
-            nodes += f'?annotations={get}'
-            newURL = tableURL + nodes
+                return None
+            except requests.exceptions.RequestException as e:
+                self.stats.record('request', service=service, outcome='error', seconds=time.monotonic() - start, bytes=0)
+                self.stats.record('fallback', service=service, reason='error')
+                warnings.warn(f'Fail to connect to the OSRM API ({type(e).__name__}), so use the haversine distance instead.')
+                return None
+            latency = time.monotonic() - start
+            self.timeouts[service].observe(latency, size)
+
+            if raw and (b'"code":"Ok"' in content):
+                succeeded = True
+                self.stats.record('request', service=service, outcome='Ok', seconds=latency, bytes=len(content))
+                return content
+            start = time.monotonic()
             try:
-                r = requests.get(newURL, timeout=timeout)
-            except requests.exceptions.Timeout:
-                warnings.warn('Exceed the maximum timeout to request, so use the haversine distance instead.')
-                timeMatx, distMatx = [], []
-                for x in nodeList:
-                    timeRow, distRow = [], []
-                    for y in nodeList:
-                        hsDist = hs.haversine((x[1],x[0]),(y[1],y[0]), unit=hs.Unit.METERS)
-                        if (timeUnit == 'second'):
-                            timeRow.append(hsDist/(speed/3.6))
-                        elif (timeUnit == 'minute'):
-                            timeRow.append((hsDist/(speed/3.6))/60)
-                        elif (timeUnit == 'hour'):
-                            timeRow.append((hsDist/(speed/3.6))/60/60)
-                        else:
-                            raise ValueError(f"timeUnit '{timeUnit}' not understood.")
-                        
-                        if (distUnit == 'm'):
-                            distRow.append(hsDist)
-                        elif (distUnit == 'km'):
-                            distRow.append(hsDist/1000)
-                        else:
-                            raise ValueError(f"distUnit '{distUnit}' not understood.")
-                    timeMatx.append(timeRow)
-                    distMatx.append(distRow)
-                return np.round(np.array(timeMatx), decimals), np.round(np.array(distMatx), decimals)
-
-            tableInfo = json.loads(r.content)
-            if (tableInfo['code'] == 'Ok'):
-                if (timeUnit == 'second'):
-                    timeMatx = np.array(tableInfo['durations'])
-                elif (timeUnit == 'minute'):
-                    timeMatx = np.array(tableInfo['durations']) / 60
-                elif (timeUnit == 'hour'):
-                    timeMatx = np.array(tableInfo['durations']) / 60 / 60
-                else:
-                    raise ValueError(f"timeUnit '{timeUnit}' not understood.")
-                
-                if (distUnit == 'm'):
-                    distMatx = np.array(tableInfo['distances'])
-                elif (distUnit == 'km'):
-                    distMatx = np.array(tableInfo['distances']) / 1000
-                else:
-                    raise ValueError(f"distUnit '{distUnit}' not understood.")
-                return np.round(np.array(timeMatx), decimals), np.round(np.array(distMatx), decimals)
+                info = _loads(content)
+                code = info['code']
+            except (ValueError, KeyError, TypeError) as e:
+                self.stats.record('request', service=service, outcome='error', seconds=latency, bytes=len(content))
+                self.stats.record('fallback', service=service, reason='error')
+                warnings.warn(f'Fail to parse the response of the OSRM API ({type(e).__name__}), so use the haversine distance instead.')
+                return None
+            self.stats.record('decode', name=service, seconds=time.monotonic() - start)
+            self.stats.record('request', service=service, outcome=code, seconds=latency, bytes=len(content))
+            if code == 'Ok':
+                succeeded = True
+                return info
+            self.stats.record('fallback', service=service, reason='code')
+            warnings.warn('Fail to get data from the OSRM API, so use the haversine distance instead.')
+            return None
+        finally:
+            if succeeded:
+                self.breaker.recordSuccess()
             else:
-                warnings.warn('Fail to get data from the OSRM API, so use the haversine distance instead.')
-                timeMatx, distMatx = [], []
-                for x in nodeList:
-                    timeRow, distRow = [], []
-                    for y in nodeList:
-                        hsDist = hs.haversine((x[1],x[0]),(y[1],y[0]), unit=hs.Unit.METERS)
-                        if (timeUnit == 'second'):
-                            timeRow.append(hsDist/(speed/3.6))
-                        elif (timeUnit == 'minute'):
-                            timeRow.append((hsDist/(speed/3.6))/60)
-                        elif (timeUnit == 'hour'):
-                            timeRow.append((hsDist/(speed/3.6))/60/60)
-                        else:
-                            raise ValueError(f"timeUnit '{timeUnit}' not understood.")
-                        
-                        if (distUnit == 'm'):
-                            distRow.append(hsDist)
-                        elif (distUnit == 'km'):
-                            distRow.append(hsDist/1000)
-                        else:
-                            raise ValueError(f"distUnit '{distUnit}' not understood.")
-                    timeMatx.append(timeRow)
-                    distMatx.append(distRow)
-                return np.round(np.array(timeMatx), decimals), np.round(np.array(distMatx), decimals)
+                self.breaker.recordFailure()
+
+    def _coordinates(self, nodeList):
+        return _formatCoordinates(nodeList, self.encoding, self.precision)
+
+    def urlLength(self, service, nodeList, sources=None, destinations=None):
+        """ The length of the URL requesting `nodeList` from `service` ('route' or 'table') with the configured encoding and cached hints """
+        url = f'{self.baseURL}/{service}/v1/{self.profile}/' + self._coordinates(nodeList) + '?'
+        for name, index in (('sources', sources), ('destinations', destinations)):
+            if index is not None:
+                url += f'{name}=' + ';'.join(map(str, np.atleast_1d(index).tolist())) + '&'
+        url += 'annotations=duration,distance' if service == 'table' else 'steps=false&overview=false'
+        return len(url + self._hintQuery(np.asarray(nodeList, dtype=np.float64).reshape(-1, 2).tolist(), record=False))
+
+    def _urlBudget(self, nodeArr):
+        """ The URL length per node estimated from a sample of `nodeArr`, and the length left for the nodes within maxURLLength """
+        sample = nodeArr[:1000]
+        fixed = self.urlLength('table', sample[:0])
+        perNode = len(self._coordinates(sample)) / max(len(sample), 1) + 1
+        if self.hints is not None:
+            # 較早完成的區塊會存入 hint，使之後區塊的 URL 變長；因此不論目前是否已有快取，每個點都預留一個 hint 的長度
+            perNode += self.hints.longest(self.profile) + 1
+        return perNode, self.maxURLLength - fixed - len('&sources=&destinations=&hints=')
+
+    def _urlTileSize(self, nodeArr, srcIdx, dstIdx):
+        """ The largest tileSize whose /table URLs fit in maxURLLength, or None if the whole table fits """
+        tableNodes = nodeArr[np.unique(np.concatenate([srcIdx, dstIdx]))]
+        perNode, budget = self._urlBudget(tableNodes)
+        if perNode * len(tableNodes) <= budget:
+            return None
+        # 每個區塊最多有 2 * tileSize 個座標，外加 sources 與 destinations 的索引
+        perIndex = len(str(len(tableNodes))) + 1
+        return max(int(budget // (2 * perNode + 2 * perIndex)), 1)
+
+    def _hintQuery(self, nodes, record=True):
+        """ The '&hints=...' parameter of the cached hints of `nodes`, or '' if none is cached """
+        if self.hints is None:
+            return ''
+        hints = self.hints.getMany(self.profile, nodes, record)
+        return '&hints=' + ';'.join(hints) if any(hints) else ''
+
+    def _storeHints(self, nodes, hints):
+        if (self.hints is not None) and (len(hints) == len(nodes)):
+            self.hints.setMany(self.profile, nodes, hints)
+
+    def _remember(self, memoKey, route):
+        now = time.monotonic()
+        with self._memoLock:
+            if len(self._memo) >= 1024:
+                self._memo = {key: memo for key, memo in self._memo.items() if memo[0] > now}
+            self._memo[memoKey] = (now + self.memoTTL, route)
+
+    def odMatrix(self, nodeList, get='distance', sources=None, distUnit='m', timeUnit='second', timeout=None, speed=30, decimals=1, dtype=np.float64,
+                 tileSize=None, workers=None, destinations=None, destnList=None, nullValue=np.nan, outFile=None, provenance=False):
+        """ Get the O-D Matrix from all nodes in `nodeList` """
+        # nodeList: [(), (), ... , ()]
+        # get: 'duration', 'distance' 或 'duration;distance'，後者回傳 (timeMatx, distMatx)
+        # sources / destinations: 作為起點 / 迄點的 nodeList 索引（int 或 list），None 表示全部；sources = 0 will return 1xN matrix
+        # destnList: 另外指定迄點座標，此時 nodeList 只作為起點，destinations 則為 destnList 的索引
+        # tileSize: 每次 /table 請求最多包含的 sources 與 destinations 數量，None 表示整個矩陣只發一次請求
+        # dtype: 回傳矩陣的型別，np.float32 可省下一半記憶體；nullValue: OSRM 無法到達（null）的格子所填入的值
+        # outFile: 將矩陣逐塊寫入此檔案（np.memmap）並回傳唯讀的 memmap；中斷後以相同參數再次呼叫會從未完成的區塊繼續
+        # provenance=True 時在回傳值最後多一個布林矩陣 fromOSRM：True 表示該格來自 OSRM（或其快取），False 表示 haversine 備援
+        self.stats.record('call', name='odMatrix')
+        return self._odMatrix(nodeList, get=get, sources=sources, distUnit=distUnit, timeUnit=timeUnit, timeout=timeout, speed=speed,
+                              decimals=decimals, dtype=dtype, tileSize=tileSize, workers=workers, destinations=destinations,
+                              destnList=destnList, nullValue=nullValue, outFile=outFile, provenance=provenance)
+
+    def _odMatrix(self, nodeList, get='distance', sources=None, distUnit='m', timeUnit='second', timeout=None, speed=30, decimals=1, dtype=np.float64,
+                  tileSize=None, workers=None, destinations=None, destnList=None, nullValue=np.nan, outFile=None, provenance=False):
+        metrics = _parseGet(get)
+        scales = {'duration': _unitScale(_TIME_UNITS, timeUnit, 'timeUnit') if 'duration' in metrics else None,
+                  'distance': _unitScale(_DIST_UNITS, distUnit, 'distUnit') if 'distance' in metrics else None}
+        nodeArr = np.asarray(nodeList, dtype=np.float64).reshape(-1, 2)
+        srcIdx = _indexArray(sources, len(nodeArr), 'sources')
+        if destnList is None:
+            dstIdx = _indexArray(destinations, len(nodeArr), 'destinations')
         else:
-            raise ValueError(f"get '{get}' not understood.")
-        
-def distSeq(nodeList=None, matrix=None, sources=None, distUnit='m', timeout=5):
-    if matrix is None:
-        matrix = odMatrix(nodeList, get='distance', sources=sources, distUnit=distUnit, timeUnit='second', timeout=timeout)
-    elif nodeList is None:
-        matrix = matrix
-    seq = []
-    i = 0
-    j = 1
-    try:
-        while i < matrix.shape[0]-1:
-            while j < matrix.shape[1]:
-                seq.append(matrix[i][j])
-                i += 1
-                j += 1
-        return seq
-    except:
-        return matrix
-
-def travTimeSeq(nodeList=None, matrix=None, sources=None, timeUnit='second', timeout=5):
-    if matrix is None:
-        matrix = odMatrix(nodeList, get='duration', sources=sources, distUnit='m', timeUnit=timeUnit, timeout=timeout)
-    elif nodeList is None:
-        matrix = matrix
-    seq = []
-    i = 0
-    j = 1
-    while i < matrix.shape[0]-1:
-        while j < matrix.shape[1]:
-            seq.append(matrix[i][j])
-            i += 1
-            j += 1
-    return seq
+            destnArr = np.asarray(destnList, dtype=np.float64).reshape(-1, 2)
+            dstIdx = len(nodeArr) + _indexArray(destinations, len(destnArr), 'destinations')
+            nodeArr = np.concatenate([nodeArr, destnArr])
+        if (tileSize is None) and (self.maxURLLength is not None):
+            tileSize = self._urlTileSize(nodeArr, srcIdx, dstIdx)
+        if outFile is not None:
+            return self._odMemmap(outFile, nodeArr, srcIdx, dstIdx, metrics, scales, timeout, speed, decimals, dtype,
+                                  tileSize or 100, workers, nullValue, provenance)
+        matrices = {metric: np.empty((len(srcIdx), len(dstIdx)), dtype=dtype) for metric in metrics}
+        mask = np.empty((len(srcIdx), len(dstIdx)), dtype=bool) if provenance else None
+        if self.cache is None:
+            self._fillMatrices(nodeArr, srcIdx, dstIdx, matrices, metrics, timeout, speed, tileSize, workers, mask)
+        else:
+            self._fillFromCache(nodeArr, srcIdx, dstIdx, matrices, metrics, timeout, speed, tileSize, workers, mask)
+        start = time.monotonic()
+        result = _finishMatrices(matrices, metrics, scales, decimals, nullValue)
+        self.stats.record('post', name='odMatrix', seconds=time.monotonic() - start)
+        if not provenance:
+            return result
+        return (*result, mask) if len(metrics) > 1 else (result, mask)
+
+    def _odMemmap(self, outFile, nodeArr, srcIdx, dstIdx, metrics, scales, timeout, speed, decimals, dtype, tileSize, workers, nullValue,
+                  provenance=False):
+        """ Build the O-D matrix tile by tile into `outFile`, resuming the tiles left unfinished by an earlier call """
+        # outFile 存放形狀為 (len(metrics), M, N) 的矩陣；outFile.json 記錄參數，outFile.tiles 記錄每個區塊的狀態
+        # 區塊狀態：0 未完成、1 來自 OSRM、2 haversine 備援（續跑時會重新請求）
+        # provenance=True 時依區塊狀態另外寫出 outFile.osrm（形狀為 (M, N) 的布林 memmap）
+        tiles = _tiles(len(srcIdx), len(dstIdx), tileSize)
+        shape = (len(metrics), len(srcIdx), len(dstIdx))
+        digest = hashlib.sha1(np.ascontiguousarray(nodeArr[srcIdx]).tobytes() + np.ascontiguousarray(nodeArr[dstIdx]).tobytes())
+        meta = {'shape': list(shape), 'dtype': np.dtype(dtype).str, 'metrics': list(metrics), 'profile': self.profile,
+                'scales': [scales[metric] for metric in metrics], 'decimals': decimals, 'nullValue': str(nullValue),
+                'tileSize': tileSize, 'nodes': digest.hexdigest()}
+        metaFile, tileFile = outFile + '.json', outFile + '.tiles'
+        resume = False
+        if os.path.exists(outFile) and os.path.exists(metaFile) and os.path.exists(tileFile):
+            with open(metaFile) as f:
+                resume = (json.load(f) == meta)
+        mode = 'r+' if resume else 'w+'
+        matrix = np.memmap(outFile, dtype=dtype, mode=mode, shape=shape)
+        state = np.memmap(tileFile, dtype=np.uint8, mode=mode, shape=(len(tiles),))
+        if not resume:
+            with open(metaFile, 'w') as f:
+                json.dump(meta, f)
+
+        def fill(k):
+            rows, cols = tiles[k]
+            outs = {metric: matrix[i, rows, cols] for i, metric in enumerate(metrics)}
+            fromOSRM = self._tableTile(nodeArr, srcIdx[rows], dstIdx[cols], outs, metrics, timeout, speed)
+            if fromOSRM and (self.cache is not None):
+                self._storeTile(nodeArr, srcIdx[rows], dstIdx[cols], outs, metrics)
+            start = time.monotonic()
+            _finishMatrices(outs, metrics, scales, decimals, nullValue)
+            self.stats.record('post', name='odMatrix', seconds=time.monotonic() - start)
+            state[k] = 1 if fromOSRM else 2
+
+        todo = np.flatnonzero(state != 1).tolist()
+        with ThreadPoolExecutor(max_workers=workers or self.poolSize) as executor:
+            list(executor.map(fill, todo))
+        matrix.flush()
+        state.flush()
+        if provenance:
+            mask = np.memmap(outFile + '.osrm', dtype=bool, mode='w+', shape=shape[1:])
+            for k, (rows, cols) in enumerate(tiles):
+                mask[rows, cols] = (state[k] == 1)
+            mask.flush()
+            del mask
+        del matrix, state
+
+        matrix = np.memmap(outFile, dtype=dtype, mode='r', shape=shape)
+        result = (matrix[0],) if len(metrics) == 1 else (matrix[0], matrix[1])
+        if provenance:
+            result += (np.memmap(outFile + '.osrm', dtype=bool, mode='r', shape=shape[1:]),)
+        return result[0] if len(result) == 1 else result
+
+    def _fillMatrices(self, nodeArr, srcIdx, dstIdx, matrices, metrics, timeout, speed, tileSize, workers, mask=None):
+        """ Fill the preallocated `matrices` tile by tile, requesting the tiles in parallel """
+        # mask: 若給定則逐格記錄是否來自 OSRM
+        tiles = _tiles(len(srcIdx), len(dstIdx), tileSize)
+        def fill(tile):
+            rows, cols = tile
+            outs = {metric: matrices[metric][rows, cols] for metric in metrics}
+            fromOSRM = self._tableTile(nodeArr, srcIdx[rows], dstIdx[cols], outs, metrics, timeout, speed)
+            if fromOSRM and (self.cache is not None):
+                self._storeTile(nodeArr, srcIdx[rows], dstIdx[cols], outs, metrics)
+            if mask is not None:
+                mask[rows, cols] = fromOSRM
+
+        if len(tiles) == 1:
+            fill(tiles[0])
+        else:
+            with ThreadPoolExecutor(max_workers=workers or self.poolSize) as executor:
+                list(executor.map(fill, tiles))
+
+    def _tableTile(self, nodeArr, srcIdx, dstIdx, outs, metrics, timeout, speed):
+        """ Request the `srcIdx` x `dstIdx` block of the table into `outs`, falling back to haversine for this block only """
+        # 只送出此區塊用到的座標，再以 sources/destinations 指定其中的起訖點
+        tileNodes, inverse = np.unique(np.concatenate([srcIdx, dstIdx]), return_inverse=True)
+        srcPos, dstPos = inverse[:len(srcIdx)], inverse[len(srcIdx):]
+        nodes = self._coordinates(nodeArr[tileNodes]) + '?'
+        if (len(srcPos) != len(tileNodes)) or np.any(srcPos != np.arange(len(tileNodes))):
+            nodes += 'sources=' + ';'.join(map(str, srcPos.tolist())) + '&'
+        if (len(dstPos) != len(tileNodes)) or np.any(dstPos != np.arange(len(tileNodes))):
+            nodes += 'destinations=' + ';'.join(map(str, dstPos.tolist())) + '&'
+        nodes += 'annotations=' + ','.join(metrics)
+        if (self.maxURLLength is not None) and (max(len(srcIdx), len(dstIdx)) > 1):
+            # 實際的 hint 比預估的長時 URL 仍可能超過上限，此時將較長的一邊對半切開分別請求
+            length = len(f'{self.baseURL}/table/v1/{self.profile}/') + len(nodes + self._hintQuery(nodeArr[tileNodes].tolist(), record=False))
+            if length > self.maxURLLength:
+                if len(srcIdx) >= len(dstIdx):
+                    half = len(srcIdx) // 2
+                    parts = [(srcIdx[:half], dstIdx, np.s_[:half, :]), (srcIdx[half:], dstIdx, np.s_[half:, :])]
+                else:
+                    half = len(dstIdx) // 2
+                    parts = [(srcIdx, dstIdx[:half], np.s_[:, :half]), (srcIdx, dstIdx[half:], np.s_[:, half:])]
+                results = [self._tableTile(nodeArr, src, dst, {metric: outs[metric][part] for metric in metrics}, metrics, timeout, speed)
+                           for src, dst, part in parts]
+                return all(results)
+        nodes += self._hintQuery(nodeArr[tileNodes].tolist())
+        cells = len(srcIdx) * len(dstIdx)
+        # 回應無法解析時只讓這個區塊改用 haversine，其他區塊照常取得（連線失敗已由 _request 改用備援）
+        try:
+            tableInfo = self._request('table', nodes, timeout, size=1 + cells / 1e5, raw=True)
+            if tableInfo is not None:
+                if self.hints is not None:
+                    for name, pos in (('sources', srcPos), ('destinations', dstPos)):
+                        self._storeHints(nodeArr[tileNodes[pos]].tolist(), _waypointHints(tableInfo, name, len(pos)))
+                start = time.monotonic()
+                _decodeTable(tableInfo, metrics, outs)
+                self.stats.record('decode', name='table', seconds=time.monotonic() - start)
+                self.stats.record('values', source='osrm', count=cells)
+                return True
+        except (ValueError, KeyError) as e:
+            warnings.warn(f'Fail to get this block from the OSRM API ({type(e).__name__}), so use the haversine distance instead.')
+            self.stats.record('fallback', service='table', reason='error')
+
+        self.stats.record('values', source='haversine', count=cells)
+        fallback = _fallbackMatrices(nodeArr[srcIdx], nodeArr[dstIdx], metrics, speed, outs[metrics[0]].dtype)
+        for metric in metrics:
+            outs[metric][...] = fallback[metric]
+        return False
+
+    def _fillFromCache(self, nodeArr, srcIdx, dstIdx, matrices, metrics, timeout, speed, tileSize, workers, mask=None):
+        """ Fill `matrices` from the cache and request only the missing cells """
+        missing = np.zeros((len(srcIdx), len(dstIdx)), dtype=bool)
+        for metric in metrics:
+            values = self.cache.getMatrix(self.profile, metric, nodeArr[srcIdx], nodeArr[dstIdx])
+            missing |= np.isnan(values)
+            matrices[metric][...] = values
+        self.stats.record('values', source='cache', count=int(missing.size - np.count_nonzero(missing)))
+        if mask is not None:
+            np.logical_not(missing, out=mask)
+        if not missing.any():
+            return
+
+        # 缺漏位置相同的列合併成一次請求（例如新增一個點時只需 1xN 與 Nx1 兩次請求）；
+        # 若缺漏過於零散，則改為請求涵蓋所有缺漏的子矩陣，取請求數與格數估計成本較低者
+        groups = {}
+        for i in np.flatnonzero(missing.any(axis=1)).tolist():
+            groups.setdefault(missing[i].tobytes(), []).append(i)
+        blocks = [(np.array(rows), np.flatnonzero(np.frombuffer(pattern, dtype=bool))) for pattern, rows in groups.items()]
+        bbox = [(np.flatnonzero(missing.any(axis=1)), np.flatnonzero(missing.any(axis=0)))]
+        if _requestCost(bbox, tileSize) <= _requestCost(blocks, tileSize):
+            blocks = bbox
+
+        for rows, cols in blocks:
+            sub = {metric: np.empty((len(rows), len(cols)), dtype=matrices[metric].dtype) for metric in metrics}
+            subMask = None if mask is None else np.empty((len(rows), len(cols)), dtype=bool)
+            self._fillMatrices(nodeArr, srcIdx[rows], dstIdx[cols], sub, metrics, timeout, speed, tileSize, workers, subMask)
+            for metric in metrics:
+                matrices[metric][np.ix_(rows, cols)] = sub[metric]
+            if mask is not None:
+                mask[np.ix_(rows, cols)] = subMask
+
+    def _storeTile(self, nodeArr, srcIdx, dstIdx, outs, metrics):
+        for metric in metrics:
+            self.cache.setMatrix(self.profile, metric, nodeArr[srcIdx], nodeArr[dstIdx], outs[metric])
+
+    def _storeLeg(self, orign, destn, leg):
+        if self.cache is not None:
+            self.cache.setMany([(self.cache.key(self.profile, orign, destn, metric), leg[metric]) for metric in ('duration', 'distance')])
+
+    def knnMatrix(self, nodeList, k=10, get='duration', distUnit='m', timeUnit='second', timeout=None, speed=30, decimals=1,
+                  dtype=np.float64, blockSize=100, tileSize=None, workers=None, nullValue=np.nan, provenance=False):
+        """ Get the sparse O-D matrix from every node in `nodeList` to its `k` nearest other nodes """
+        # 先以直線（大圓）距離選出每個點的 k 個鄰近點，只向 OSRM 請求這 N x k 格；回傳 CSRMatrix，
+        # get='duration;distance' 時回傳 (timeCSR, distCSR)，provenance=True 時另外回傳與 indices 對齊的 fromOSRM
+        # blockSize: 沿 Z 曲線相鄰的 blockSize 個起點合併成一次 /table 請求，迄點為其鄰近點的聯集
+        self.stats.record('call', name='knnMatrix')
+        metrics = _parseGet(get)
+        nodeArr = np.asarray(nodeList, dtype=np.float64).reshape(-1, 2)
+        k = min(k, len(nodeArr) - 1)
+        if k < 1:
+            raise ValueError(f"k '{k}' not understood.")
+        neighbours = _nearestNeighbours(nodeArr, k)
+        values = {metric: np.empty((len(nodeArr), k), dtype=dtype) for metric in metrics}
+        fromOSRM = np.empty((len(nodeArr), k), dtype=bool)
+
+        def fill(block):
+            targets = np.unique(neighbours[block])
+            *matrices, mask = self._odMatrix(nodeArr, get=get, sources=block, destinations=targets, distUnit=distUnit, timeUnit=timeUnit,
+                                             timeout=timeout, speed=speed, decimals=decimals, dtype=dtype, tileSize=tileSize,
+                                             nullValue=nullValue, provenance=True)
+            rows, cols = np.arange(len(block))[:, None], np.searchsorted(targets, neighbours[block])
+            for metric, matx in zip(metrics, matrices):
+                values[metric][block] = matx[rows, cols]
+            fromOSRM[block] = mask[rows, cols]
+
+        order = _mortonOrder(nodeArr)
+        blocks = [order[start:start + blockSize] for start in range(0, len(order), blockSize)]
+        with ThreadPoolExecutor(max_workers=workers or self.poolSize) as executor:
+            list(executor.map(fill, blocks))
+
+        # 每列依欄位索引排序，與 scipy 的標準 CSR 格式一致
+        sort = np.argsort(neighbours, axis=1)
+        indices = np.take_along_axis(neighbours, sort, axis=1).ravel()
+        indptr = np.arange(0, len(nodeArr) * k + 1, k)
+        shape = (len(nodeArr), len(nodeArr))
+        result = tuple(CSRMatrix(np.take_along_axis(values[metric], sort, axis=1).ravel(), indices, indptr, shape) for metric in metrics)
+        if provenance:
+            result += (np.take_along_axis(fromOSRM, sort, axis=1).ravel(),)
+        return result[0] if len(result) == 1 else result
+
+    def distSeq(self, nodeList=None, matrix=None, sources=None, distUnit='m', timeout=None, decimals=1, maxWaypoints=500, provenance=False):
+        """ Get the distances of the consecutive legs through `nodeList` """
+        # 給定 nodeList 時以 /route 一次取得所有相鄰兩點間的距離（超過 maxWaypoints 個點時分段請求）；
+        # 給定 matrix 時則取其上方次對角線；sources 僅為相容舊版而保留
+        # provenance=True 時回傳 (distSeq, fromOSRM)，fromOSRM 逐段標示是否來自 OSRM
+        self.stats.record('call', name='distSeq')
+        if matrix is None:
+            scale = _unitScale(_DIST_UNITS, distUnit, 'distUnit')
+            legs, fromOSRM = self._routeLegs(nodeList, 'distance', timeout, 30, maxWaypoints)
+            return self._finishLegs(legs, fromOSRM, scale, decimals, provenance)
+        try:
+            return _superdiagonal(matrix)
+        except:
+            return matrix
+
+    def travTimeSeq(self, nodeList=None, matrix=None, sources=None, timeUnit='second', timeout=None, decimals=1, maxWaypoints=500, speed=30,
+                    provenance=False):
+        """ Get the travel times of the consecutive legs through `nodeList` """
+        self.stats.record('call', name='travTimeSeq')
+        if matrix is None:
+            scale = _unitScale(_TIME_UNITS, timeUnit, 'timeUnit')
+            legs, fromOSRM = self._routeLegs(nodeList, 'duration', timeout, speed, maxWaypoints)
+            return self._finishLegs(legs, fromOSRM, scale, decimals, provenance)
+        return _superdiagonal(matrix)
+
+    def _finishLegs(self, legs, fromOSRM, scale, decimals, provenance):
+        start = time.monotonic()
+        legs /= scale
+        legs = np.round(legs, decimals).tolist()
+        self.stats.record('post', name='routeLegs', seconds=time.monotonic() - start)
+        return (legs, fromOSRM.tolist()) if provenance else legs
+
+    def _routeLegs(self, nodeList, metric, timeout, speed, maxWaypoints):
+        """ The `metric` ('distance' in m or 'duration' in s) of every consecutive leg through `nodeList`, and whether each came from OSRM """
+        nodeArr = np.asarray(nodeList, dtype=np.float64).reshape(-1, 2)
+        legs = np.empty(max(len(nodeArr) - 1, 0))
+        fromOSRM = np.zeros(len(legs), dtype=bool)
+        if self.maxURLLength is not None:
+            perNode, budget = self._urlBudget(nodeArr)
+            maxWaypoints = max(min(maxWaypoints, int(budget // perNode)), 2)
+        # 相鄰兩段共用交界的點，使每一段 leg 恰好被請求一次
+        chunks = [(start, min(start + maxWaypoints - 1, len(legs))) for start in range(0, len(legs), maxWaypoints - 1)]
+
+        def fill(chunk):
+            start, stop = chunk
+            waypoints = nodeArr[start:stop + 1]
+            query = self._coordinates(waypoints) + '?steps=false&overview=false'
+            query += self._hintQuery(waypoints.tolist())
+            routeInfo = self._request('route', query, timeout, size=max(1, (stop - start) / 10))
+            if routeInfo is not None:
+                self._storeHints(waypoints.tolist(), [waypoint.get('hint') for waypoint in routeInfo.get('waypoints', [])])
+                legs[start:stop] = [leg[metric] for leg in routeInfo['routes'][0]['legs']]
+                fromOSRM[start:stop] = True
+                self.stats.record('values', source='osrm', count=stop - start)
+            else:
+                legs[start:stop] = haversinePairs(waypoints[:-1], waypoints[1:])
+                if metric == 'duration':
+                    legs[start:stop] /= speed/3.6
+                self.stats.record('values', source='haversine', count=stop - start)
+
+        if len(chunks) == 1:
+            fill(chunks[0])
+        elif chunks:
+            with ThreadPoolExecutor(max_workers=self.poolSize) as executor:
+                list(executor.map(fill, chunks))
+        return legs, fromOSRM
+
+
+class ODMatrix:
+    """ O-D matrix of a changing set of nodes, requesting only the rows and columns of the nodes added """
+
+    def __init__(self, nodeList=None, keys=None, client=None, get='duration;distance', distUnit='m', timeUnit='second', timeout=None,
+                 speed=30, decimals=1, dtype=np.float64, tileSize=None, nullValue=np.nan, capacity=16):
+        # 每個點以 key（例如站點編號）識別；未指定時依加入順序編號 0, 1, 2, ...
+        # 陣列容量不足時加倍、使用量低於四分之一時減半，移除的點由最後一個點補位，矩陣的列順序即為 self.keys
+        self.client = getDefaultClient() if client is None else client
+        self.metrics = _parseGet(get)
+        self.get = get
+        self.options = {'distUnit': distUnit, 'timeUnit': timeUnit, 'timeout': timeout, 'speed': speed, 'decimals': decimals,
+                        'dtype': dtype, 'tileSize': tileSize, 'nullValue': nullValue}
+        self.keys = []
+        self._index = {}
+        self._nextKey = 0
+        self._size = 0
+        self._capacity = 0
+        self._nodes = np.empty((0, 2))
+        self._data = {}
+        self._fromOSRM = np.empty((0, 0), dtype=bool)
+        self._resize(capacity)
+        if nodeList is not None:
+            self.addNodes(nodeList, keys)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def nodes(self):
+        return self._nodes[:self._size].tolist()
+
+    @property
+    def duration(self):
+        return self._view(self._data['duration'])
+
+    @property
+    def distance(self):
+        return self._view(self._data['distance'])
+
+    @property
+    def fromOSRM(self):
+        """ Whether each cell came from OSRM (False: haversine fallback) """
+        return self._view(self._fromOSRM)
+
+    @property
+    def matrix(self):
+        """ The current matrix, or (timeMatx, distMatx), like `odMatrix` """
+        if len(self.metrics) == 1:
+            return self._view(self._data[self.metrics[0]])
+        return self.duration, self.distance
+
+    def index(self, key):
+        """ The row / column of the node `key` """
+        return self._index[key]
+
+    def addNodes(self, nodeList, keys=None):
+        """ Add the nodes of `nodeList`, requesting only their rows and columns, and return their keys """
+        nodeArr = np.asarray(nodeList, dtype=np.float64).reshape(-1, 2)
+        if keys is None:
+            keys = list(range(self._nextKey, self._nextKey + len(nodeArr)))
+        keys = list(keys)
+        if len(keys) != len(nodeArr):
+            raise ValueError('keys and nodeList have different lengths.')
+        duplicated = [key for key in keys if key in self._index]
+        if duplicated or (len(set(keys)) != len(keys)):
+            raise ValueError(f'keys {duplicated} already exist.' if duplicated else 'keys are not unique.')
+        if not keys:
+            return []
+        self._nextKey = max([self._nextKey] + [key + 1 for key in keys if isinstance(key, int)])
+
+        old, size = self._size, self._size + len(nodeArr)
+        if size > self._capacity:
+            self._resize(max(size, 2 * self._capacity))
+        self._nodes[old:size] = nodeArr
+        for i, key in enumerate(keys, old):
+            self._index[key] = i
+        self.keys += keys
+        self._size = size
+
+        # 新點到所有點（k x (n + k)）與舊點到新點（n x k）兩次請求
+        self._fetch(np.arange(old, size), np.arange(size))
+        if old:
+            self._fetch(np.arange(old), np.arange(old, size))
+        return keys
+
+    def removeNodes(self, keys):
+        """ Remove the nodes of `keys`, moving the last nodes into the freed rows and columns """
+        # 先檢查所有 key，有任何一個不存在或重複時不做任何修改
+        keys = list(keys)
+        unknown = [key for key in keys if key not in self._index]
+        if unknown or (len(set(keys)) != len(keys)):
+            raise KeyError(f'keys {unknown} not found.' if unknown else 'keys are not unique.')
+        positions = sorted((self._index.pop(key) for key in keys), reverse=True)
+        arrays = list(self._data.values()) + [self._fromOSRM]
+        # 由大到小處理，補位的最後一個點必定不是待移除的點；每個點只需複製一列與一行
+        for pos in positions:
+            last = self._size - 1
+            if pos != last:
+                for arr in arrays:
+                    arr[pos, :last + 1] = arr[last, :last + 1]
+                    arr[:last + 1, pos] = arr[:last + 1, last]
+                self._nodes[pos] = self._nodes[last]
+                self.keys[pos] = self.keys[last]
+                self._index[self.keys[pos]] = pos
+            self.keys.pop()
+            self._size -= 1
+        capacity = self._capacity
+        while (capacity > 16) and (self._size < capacity // 4):
+            capacity //= 2
+        if capacity != self._capacity:
+            self._resize(max(capacity, 16))
+
+    def refresh(self):
+        """ Request again the rows that contain haversine fallback values """
+        rows = np.flatnonzero(~self.fromOSRM.all(axis=1))
+        if len(rows):
+            self._fetch(rows, np.arange(self._size))
+
+    def _fetch(self, srcIdx, dstIdx):
+        *matrices, mask = self.client.odMatrix(self._nodes[:self._size], get=self.get, sources=srcIdx, destinations=dstIdx,
+                                               provenance=True, **self.options)
+        block = np.ix_(srcIdx, dstIdx)
+        for metric, matx in zip(self.metrics, matrices):
+            self._data[metric][block] = matx
+        self._fromOSRM[block] = mask
+
+    def _resize(self, capacity):
+        """ Reallocate the arrays to `capacity` nodes, keeping the current cells """
+        size = self._size
+        nodes = np.empty((capacity, 2))
+        nodes[:size] = self._nodes[:size]
+        self._nodes = nodes
+        for metric in self.metrics:
+            data = np.empty((capacity, capacity), dtype=self.options['dtype'])
+            if metric in self._data:
+                data[:size, :size] = self._data[metric][:size, :size]
+            self._data[metric] = data
+        fromOSRM = np.zeros((capacity, capacity), dtype=bool)
+        fromOSRM[:size, :size] = self._fromOSRM[:size, :size]
+        self._fromOSRM = fromOSRM
+        self._capacity = capacity
+
+    def _view(self, arr):
+        view = arr[:self._size, :self._size]
+        view.flags.writeable = False
+        return view
+
+
+_defaultClient = None
+_defaultServer = None     # 建立 _defaultClient 時的 (baseURL, profile)；由 setDefaultClient 指定時為 None
+
+
+def _globalServer():
+    """ The (baseURL, profile) set through the module globals `baseURL`, `tableURL` and `routeURL` """
+    # tableURL / routeURL 只有在被改成與初始值不同時才優先於 baseURL，否則只修改 baseURL 時會被舊的預設值蓋過
+    servers = set()
+    for service, url in (('table', tableURL), ('route', routeURL)):
+        if url != _INITIAL_URLS[service]:
+            match = re.match(rf'^(.+)/{service}/v1/([^/]+)/?$', url)
+            if match is None:
+                raise ValueError(f"{service}URL '{url}' not understood.")
+            servers.add((match.group(1), match.group(2)))
+    if len(servers) > 1:
+        raise ValueError('tableURL and routeURL point to different servers, use an OSRMClient for each instead.')
+    return servers.pop() if servers else (baseURL.rstrip('/'), 'driving')
+
+def getDefaultClient():
+    """ Get the client shared by the module-level functions """
+    # 未呼叫 setDefaultClient 時，模組的 baseURL / tableURL / routeURL 改變後會重新建立 client
+    global _defaultClient, _defaultServer
+    if (_defaultClient is None) or ((_defaultServer is not None) and (_defaultServer != _globalServer())):
+        if _defaultClient is not None:
+            _defaultClient.close()
+        _defaultServer = _globalServer()
+        _defaultClient = OSRMClient(_defaultServer[0], profile=_defaultServer[1])
+    return _defaultClient
+
+def setDefaultClient(client):
+    """ Replace the client shared by the module-level functions """
+    global _defaultClient, _defaultServer
+    _defaultClient = client
+    _defaultServer = None
+
+def getStats():
+    """ Get the ClientStats of the client shared by the module-level functions """
+    return getDefaultClient().stats
+
+def distance(orign, destn, unit='m', steps='false', timeout=None):
+    """ Get the distance between `orign` and `destn` """
+    return getDefaultClient().distance(orign, destn, unit=unit, steps=steps, timeout=timeout)
+
+def travTime(orign, destn, unit='second', steps='false', timeout=None, speed=30):
+    """ Get the travel time between `orign` and `destn` """
+    return getDefaultClient().travTime(orign, destn, unit=unit, steps=steps, timeout=timeout, speed=speed)
+
+def route(orign, destn, steps='false', geometry=False, timeout=None, speed=30):
+    """ Get the distance (m), travel time (s) and summary between `orign` and `destn` from one request """
+    return getDefaultClient().route(orign, destn, steps=steps, geometry=geometry, timeout=timeout, speed=speed)
+
+async def distanceMany(pairs, unit='m', timeout=None, concurrency=None):
+    """ Get the distances of all (orign, destn) pairs in `pairs` concurrently """
+    return await getDefaultClient().distanceMany(pairs, unit=unit, timeout=timeout, concurrency=concurrency)
+
+async def travTimeMany(pairs, unit='second', timeout=None, speed=30, concurrency=None):
+    """ Get the travel times of all (orign, destn) pairs in `pairs` concurrently """
+    return await getDefaultClient().travTimeMany(pairs, unit=unit, timeout=timeout, speed=speed, concurrency=concurrency)
+
+def odMatrix(nodeList, get='distance', sources=None, distUnit='m', timeUnit='second', timeout=None, speed=30, decimals=1, dtype=np.float64,
+             tileSize=None, workers=None, destinations=None, destnList=None, nullValue=np.nan, outFile=None, provenance=False):
+    """ Get the O-D Matrix from all nodes in `nodeList` """
+    return getDefaultClient().odMatrix(nodeList, get=get, sources=sources, distUnit=distUnit, timeUnit=timeUnit,
+                                       timeout=timeout, speed=speed, decimals=decimals, dtype=dtype,
+                                       tileSize=tileSize, workers=workers, destinations=destinations, destnList=destnList,
+                                       nullValue=nullValue, outFile=outFile, provenance=provenance)
+
+def knnMatrix(nodeList, k=10, get='duration', distUnit='m', timeUnit='second', timeout=None, speed=30, decimals=1, dtype=np.float64,
+              blockSize=100, tileSize=None, workers=None, nullValue=np.nan, provenance=False):
+    """ Get the sparse O-D matrix from every node in `nodeList` to its `k` nearest other nodes """
+    return getDefaultClient().knnMatrix(nodeList, k=k, get=get, distUnit=distUnit, timeUnit=timeUnit, timeout=timeout, speed=speed,
+                                        decimals=decimals, dtype=dtype, blockSize=blockSize, tileSize=tileSize, workers=workers,
+                                        nullValue=nullValue, provenance=provenance)
+
+def distSeq(nodeList=None, matrix=None, sources=None, distUnit='m', timeout=None, decimals=1, maxWaypoints=500, provenance=False):
+    """ Get the distances of the consecutive legs through `nodeList` """
+    return getDefaultClient().distSeq(nodeList=nodeList, matrix=matrix, sources=sources, distUnit=distUnit, timeout=timeout,
+                                      decimals=decimals, maxWaypoints=maxWaypoints, provenance=provenance)
+
+def travTimeSeq(nodeList=None, matrix=None, sources=None, timeUnit='second', timeout=None, decimals=1, maxWaypoints=500, speed=30,
+                provenance=False):
+    """ Get the travel times of the consecutive legs through `nodeList` """
+    return getDefaultClient().travTimeSeq(nodeList=nodeList, matrix=matrix, sources=sources, timeUnit=timeUnit, timeout=timeout,
+                                          decimals=decimals, maxWaypoints=maxWaypoints, speed=speed, provenance=provenance)
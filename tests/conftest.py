@@ -0,0 +1,33 @@
+import importlib.util
+import os
+import sys
+import warnings
+
+import pytest
+
+# 套件就是 repository 的根目錄，測試時以 osrm_api 的名稱載入，與使用者 clone 後的 import 方式相同
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if 'osrm_api' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('osrm_api', os.path.join(ROOT, '__init__.py'), submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['osrm_api'] = module
+    spec.loader.exec_module(module)
+
+from osrm_api.fakeserver import FakeOSRMServer
+
+
+DEAD_URL = 'http://127.0.0.1:9'     # 沒有服務的 port，連線會立即被拒絕
+
+
+@pytest.fixture
+def server():
+    with FakeOSRMServer() as server:
+        yield server
+
+
+@pytest.fixture(autouse=True)
+def quietFallbacks():
+    # haversine 備援的警告在個別測試中以 pytest.warns 檢查
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        yield
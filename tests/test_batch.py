@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from osrm_api import batch, osrm
+from conftest import DEAD_URL
+
+
+def _writePairs(path, n, seed=0):
+    rng = np.random.default_rng(seed)
+    pairs = np.c_[rng.uniform(121.4, 121.6, n), rng.uniform(25.0, 25.1, n), rng.uniform(121.4, 121.6, n), rng.uniform(25.0, 25.1, n)]
+    np.savetxt(path, pairs, delimiter=',', header='orign_lon,orign_lat,destn_lon,destn_lat', comments='')
+    return pairs
+
+
+def test_batch_resume(server, tmp_path):
+    inputFile, outputFile = str(tmp_path / 'pairs.csv'), str(tmp_path / 'result.csv')
+    pairs = _writePairs(inputFile, 500)
+    client = osrm.OSRMClient(server.url)
+
+    def interrupt(checkpoint):
+        if checkpoint['chunks'] == 2:
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        batch.runBatch(inputFile, outputFile, client, chunkSize=100, progress=interrupt)
+    # 模擬中斷時已寫出但尚未記入 checkpoint 的內容
+    with open(outputFile, 'a') as f:
+        f.write('partial,row\n')
+
+    chunks = []
+    checkpoint = batch.runBatch(inputFile, outputFile, client, chunkSize=100, progress=lambda c: chunks.append(c['chunks']))
+    assert chunks == [3, 4, 5]
+    assert checkpoint['rows'] == 500 and checkpoint['fallbacks'] == 0
+
+    result = np.genfromtxt(outputFile, delimiter=',', skip_header=1, usecols=range(6))
+    assert np.allclose(result[:, :4], pairs)
+    expected = [client.route(pair[:2], pair[2:]) for pair in pairs[:20].tolist()]
+    assert np.allclose(result[:20, 4], [route.duration for route in expected], atol=0.1)
+    assert np.allclose(result[:20, 5], [route.distance for route in expected], atol=0.1)
+
+
+def test_group_pairs_limits_cells_per_pair():
+    srcId, dstId = np.arange(100), np.arange(100)
+    groups = osrm._groupPairs(srcId, dstId, 100, cellsPerPair=10)
+    assert all((group.stop - group.start) <= 10 for group in groups)
+    assert sum(group.stop - group.start for group in groups) == 100
+
+    # 同一個起點的 pair 仍只受 tileSize 限制
+    assert osrm._groupPairs(np.zeros(50, dtype=int), np.arange(50), 100, cellsPerPair=10) == [slice(0, 50)]
+
+
+def test_coalescing(server):
+    rng = np.random.default_rng(0)
+    hubs = rng.uniform([121.4, 25.0], [121.6, 25.1], (10, 2)).round(6).tolist()
+    pairs = [(tuple(hubs[i]), tuple(hubs[j])) for i in range(10) for j in range(10) if i != j]
+    reference = osrm.OSRMClient(server.url, memoTTL=0)
+    expected = [reference.distance(*pair) for pair in pairs]
+
+    client = osrm.OSRMClient(server.url, memoTTL=0, coalesceWindow=0.02, coalesceBatch=100)
+    before = server.requests
+    with ThreadPoolExecutor(32) as executor:
+        got = list(executor.map(lambda pair: client.distance(*pair), pairs))
+    assert np.allclose(got, expected)
+    assert server.requests - before < len(pairs) / 4
+    assert client.stats.coalesced['lookups'] == len(pairs)
+
+
+def test_coalescing_falls_back_when_server_is_down():
+    client = osrm.OSRMClient(DEAD_URL, retries=0, memoTTL=0, coalesceWindow=0.01)
+    pairs = [((121.5, 25.0 + i * 0.001), (121.6, 25.1)) for i in range(10)]
+    with ThreadPoolExecutor(10) as executor:
+        routes = list(executor.map(lambda pair: client.route(*pair), pairs))
+    assert all(route.source == 'haversine' for route in routes)
+
+
+@pytest.mark.parametrize('cellsPerPair, maxCells', [(None, 100000), (10, 10000), (1, 1000)])
+def test_batch_packs_random_pairs_without_quadratic_cells(server, tmp_path, cellsPerPair, maxCells):
+    inputFile, outputFile = str(tmp_path / 'pairs.csv'), str(tmp_path / 'result.csv')
+    pairs = _writePairs(inputFile, 1000)
+    cells = []
+    answer = server.answer
+
+    def countCells(service, coordinates, query):
+        status, info = answer(service, coordinates, query)
+        cells.append(np.size(info.get('durations', [])))
+        return status, info
+
+    server.answer = countCells
+    client = osrm.OSRMClient(server.url)
+    batch.runBatch(inputFile, outputFile, client, chunkSize=1000, cellsPerPair=cellsPerPair)
+    assert sum(cells) <= maxCells
+    result = np.genfromtxt(outputFile, delimiter=',', skip_header=1, usecols=range(6))
+    assert np.allclose(result[:, :4], pairs)
+    expected = [client.route(pair[:2], pair[2:]).duration for pair in pairs[:20].tolist()]
+    assert np.allclose(result[:20, 4], expected, atol=0.1)
@@ -0,0 +1,90 @@
+import asyncio
+
+import numpy as np
+
+from osrm_api import osrm
+
+
+def _pairs(n, seed=0):
+    rng = np.random.default_rng(seed)
+    nodes = np.c_[rng.uniform(121.4, 121.6, (n, 2)), rng.uniform(25.0, 25.1, (n, 2))]
+    return [((a, c), (b, d)) for a, b, c, d in nodes.round(6).tolist()]
+
+
+def test_distance_many_keeps_order_and_falls_back_per_pair(server):
+    pairs = _pairs(60)
+    reference = osrm.OSRMClient(server.url, memoTTL=0)
+    expected = np.array([reference.distance(*pair) for pair in pairs])
+
+    # 起點緯度大於 25.05 的 pair 回傳非 Ok，只有這些 pair 改用 haversine
+    answer = server.answer
+    failed = np.array([orign[1] > 25.05 for orign, _ in pairs])
+
+    def failNorth(service, coordinates, query):
+        if server._coordinates(coordinates)[0][1] > 25.05:
+            return 400, {'code': 'NoRoute', 'message': 'Injected error'}
+        return answer(service, coordinates, query)
+
+    server.answer = failNorth
+    # 斷路器不開啟，避免失敗的 pair 讓其他 pair 也改用 haversine
+    client = osrm.OSRMClient(server.url, memoTTL=0, breaker=osrm.CircuitBreaker(threshold=float('inf')))
+    got = asyncio.run(client.distanceMany(pairs, concurrency=8))
+    assert got.shape == (60,) and 0 < failed.sum() < 60
+    assert np.array_equal(got[~failed], expected[~failed])
+    fallback = [osrm._fallbackRoute(*pair, 30).distance for pair, bad in zip(pairs, failed) if bad]
+    assert np.allclose(got[failed], fallback)
+    assert client.stats.fallbacks == {'code': int(failed.sum())}
+
+    travTime = asyncio.run(client.travTimeMany(pairs, unit='minute', concurrency=8))
+    assert np.allclose(travTime[failed] * 60, [osrm._fallbackRoute(*pair, 30).duration for pair, bad in zip(pairs, failed) if bad])
+
+
+def test_distance_and_travtime_share_one_request(server):
+    orign, destn = _pairs(1)[0]
+    client = osrm.OSRMClient(server.url, memoTTL=1.0)
+    before = server.requests
+    distance = client.distance(orign, destn, unit='km')
+    travTime = client.travTime(orign, destn, unit='minute')
+    assert server.requests - before == 1
+    assert client.stats.values == {'osrm': 1, 'cache': 1}
+    route = client.route(orign, destn)
+    assert (distance, travTime) == (route.distance / 1000, route.duration / 60)
+
+    # memoTTL=0 時不暫存，每次都重新請求
+    client = osrm.OSRMClient(server.url, memoTTL=0)
+    before = server.requests
+    client.distance(orign, destn)
+    client.travTime(orign, destn)
+    assert server.requests - before == 2
+
+
+def test_hints_reused_and_invalidated_on_checksum_change(server):
+    rng = np.random.default_rng(0)
+    nodes = np.c_[rng.uniform(121.4, 121.6, 20), rng.uniform(25.0, 25.1, 20)].round(6)
+    client = osrm.OSRMClient(server.url, memoTTL=0, hints=osrm.HintCache())
+    expected = osrm.OSRMClient(server.url).odMatrix(nodes)
+    hinted, snapped = server.hinted, server.snapped
+
+    # 第一次請求須由伺服器對應每個座標，之後 /table 與 /route 都送出快取的 hint
+    client.odMatrix(nodes)
+    assert (server.hinted - hinted, server.snapped - snapped) == (0, 20)
+    assert np.array_equal(client.odMatrix(nodes), expected)
+    client.route(nodes[0].tolist(), nodes[1].tolist())
+    assert (server.hinted - hinted, server.snapped - snapped) == (22, 20)
+
+    # 伺服器更新地圖資料：舊 hint 無效，伺服器重新對應，client 清除該 profile 的 hint 後改存新的
+    server.checksum = 2
+    assert np.array_equal(client.odMatrix(nodes), expected)
+    assert (server.hinted - hinted, server.snapped - snapped) == (22, 40)
+    assert client.hints.invalidations == 1
+    client.odMatrix(nodes)
+    assert (server.hinted - hinted, server.snapped - snapped) == (42, 40)
+
+
+def test_hint_cache_is_bounded():
+    hints = osrm.HintCache(maxSize=10)
+    nodes = [(121.5 + i * 0.001, 25.0) for i in range(25)]
+    hints.setMany('driving', nodes, [f'hint{i}' for i in range(25)])
+    assert hints.stats()['memorySize'] == 10
+    assert hints.getMany('driving', nodes[:15]) == [''] * 15
+    assert hints.getMany('driving', nodes[15:]) == [f'hint{i}' for i in range(15, 25)]
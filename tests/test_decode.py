@@ -0,0 +1,72 @@
+import json
+
+import numpy as np
+import pytest
+
+from osrm_api import osrm
+
+
+def _response(durations, distances=None):
+    info = {'code': 'Ok', 'durations': durations}
+    if distances is not None:
+        info['distances'] = distances
+    return json.dumps(info, separators=(',', ':')).encode()
+
+
+def _decode(tableInfo, shape, metrics=('duration',), chunkBytes=1 << 22):
+    outs = {metric: np.empty(shape) for metric in metrics}
+    osrm._decodeTable(tableInfo, metrics, outs, chunkBytes)
+    return outs
+
+
+@pytest.mark.parametrize('chunkBytes', [1, 7, 64, 1 << 22])
+def test_decode_chunk_boundaries(chunkBytes):
+    rng = np.random.default_rng(0)
+    durations = rng.uniform(0, 1000, (30, 17)).round(1)
+    distances = rng.uniform(0, 1000, (30, 17)).round(1)
+    content = _response(durations.tolist(), distances.tolist())
+    outs = _decode(content, (30, 17), ('duration', 'distance'), chunkBytes)
+    assert np.array_equal(outs['duration'], durations)
+    assert np.array_equal(outs['distance'], distances)
+
+
+@pytest.mark.parametrize('raw', [True, False])
+def test_decode_nulls(raw):
+    durations = [[0, None, 3.5], [None, 0, None]]
+    content = _response(durations)
+    out = _decode(content if raw else json.loads(content), (2, 3), chunkBytes=4)['duration']
+    assert np.array_equal(out, [[0, np.nan, 3.5], [np.nan, 0, np.nan]], equal_nan=True)
+
+
+def test_decode_empty_table():
+    assert _decode(_response([]), (0, 5))['duration'].shape == (0, 5)
+
+
+@pytest.mark.parametrize('durations', [
+    [[7]],                          # 列數與列長都不足，過去會 broadcast 成整列 7
+    [[1, 2, 3], [4, 5, 6]],         # 少一列
+    [[1, 2, 3]] * 4,                # 多一列
+    [[1, 2, 3], [4, 5], [6, 7, 8]], # 列長不符
+    [[1, 2, 3], 4, [5, 6, 7]],      # 不是巢狀 list
+])
+@pytest.mark.parametrize('raw', [True, False])
+def test_decode_rejects_malformed_shapes(durations, raw):
+    content = _response(durations)
+    with pytest.raises(ValueError):
+        _decode(content if raw else json.loads(content), (3, 3), chunkBytes=4)
+
+
+def test_malformed_table_falls_back(server):
+    answer = server.answer
+
+    def truncated(service, coordinates, query):
+        status, info = answer(service, coordinates, query)
+        info['durations'] = [[7]]
+        return status, info
+
+    server.answer = truncated
+    client = osrm.OSRMClient(server.url)
+    nodes = [(121.5, 25.0), (121.55, 25.05), (121.6, 25.1)]
+    matx, fromOSRM = client.odMatrix(nodes, get='duration', provenance=True)
+    assert not fromOSRM.any()
+    assert np.array_equal(matx, osrm.OSRMClient('http://127.0.0.1:9', retries=0).odMatrix(nodes, get='duration'))
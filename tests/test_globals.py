@@ -0,0 +1,46 @@
+import pytest
+
+from osrm_api import osrm
+
+
+@pytest.fixture
+def globalURLs(monkeypatch):
+    # 測試結束後還原模組變數與預設 client
+    for name in ('baseURL', 'tableURL', 'routeURL', '_defaultClient', '_defaultServer'):
+        monkeypatch.setattr(osrm, name, getattr(osrm, name))
+    monkeypatch.setattr(osrm, '_defaultClient', None)
+    monkeypatch.setattr(osrm, '_defaultServer', None)
+    yield
+    if osrm._defaultClient is not None:
+        osrm._defaultClient.close()
+
+
+A, B = (121.5, 25.0), (121.55, 25.05)
+
+
+@pytest.mark.parametrize('name, value', [
+    ('baseURL', '{url}'),
+    ('tableURL', '{url}/table/v1/driving/'),
+    ('routeURL', '{url}/route/v1/driving/'),
+])
+def test_module_globals_select_default_server(server, globalURLs, name, value):
+    assert osrm.getDefaultClient().baseURL == 'http://router.project-osrm.org'
+    setattr(osrm, name, value.format(url=server.url))
+    assert osrm.getDefaultClient().baseURL == server.url
+    assert osrm.distance(A, B) > 0
+    assert server.requests == 1
+
+
+def test_globals_profile_and_conflicts(server, globalURLs):
+    osrm.routeURL = f'{server.url}/route/v1/foot'
+    assert osrm.getDefaultClient().profile == 'foot'
+    osrm.tableURL = 'http://example.com/table/v1/driving/'
+    with pytest.raises(ValueError):
+        osrm.getDefaultClient()
+
+
+def test_set_default_client_wins_over_globals(server, globalURLs):
+    client = osrm.OSRMClient(server.url)
+    osrm.setDefaultClient(client)
+    osrm.baseURL = 'http://127.0.0.1:9'
+    assert osrm.getDefaultClient() is client
@@ -0,0 +1,259 @@
+import numpy as np
+import pytest
+
+from osrm_api import osrm
+from conftest import DEAD_URL
+
+
+def _nodes(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.c_[rng.uniform(121.4, 121.6, n), rng.uniform(25.0, 25.1, n)]
+
+
+def test_polyline_round_trip():
+    # Google 文件中的範例，座標為 (lon, lat)
+    nodes = [(-120.2, 38.5), (-120.95, 40.7), (-126.453, 43.252)]
+    assert osrm.encodePolyline(nodes) == '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+    assert np.allclose(osrm.decodePolyline('_p~iF~ps|U_ulLnnqC_mqNvxq`@'), nodes)
+
+    nodes = _nodes(200).round(6)
+    assert np.allclose(osrm.decodePolyline(osrm.encodePolyline(nodes, 6), 6), nodes)
+
+
+def test_polyline_encoding_matches_plain(server):
+    nodes = _nodes(30)
+    plain = osrm.OSRMClient(server.url).odMatrix(nodes)
+    encoded = osrm.OSRMClient(server.url, encoding='polyline6').odMatrix(nodes)
+    assert np.allclose(plain, encoded, atol=1)
+
+
+def test_failed_tile_falls_back_alone(server):
+    client = osrm.OSRMClient(server.url)
+    nodes = _nodes(40)
+    request, calls = client._request, []
+
+    def failSecond(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 2:
+            raise ValueError('broken response')
+        return request(*args, **kwargs)
+
+    client._request = failSecond
+    matx, fromOSRM = client.odMatrix(nodes, tileSize=20, workers=1, provenance=True)
+    assert matx.shape == (40, 40)
+    assert fromOSRM.sum() == 3 * 20 * 20
+
+
+def test_memmap_resume(server, tmp_path):
+    client = osrm.OSRMClient(server.url)
+    nodes = _nodes(60)
+    full = client.odMatrix(nodes, get='duration;distance')
+    outFile = str(tmp_path / 'matx.dat')
+
+    tableTile, calls = client._tableTile, []
+
+    def crash(*args):
+        calls.append(1)
+        if len(calls) > 3:
+            raise KeyboardInterrupt
+        return tableTile(*args)
+
+    client._tableTile = crash
+    with pytest.raises(KeyboardInterrupt):
+        client.odMatrix(nodes, get='duration;distance', tileSize=20, workers=1, outFile=outFile)
+    client._tableTile = tableTile
+
+    before = server.requests
+    duration, distance = client.odMatrix(nodes, get='duration;distance', tileSize=20, workers=1, outFile=outFile)
+    assert server.requests - before == 9 - 3
+    assert np.array_equal(duration, full[0]) and np.array_equal(distance, full[1])
+
+    before = server.requests
+    client.odMatrix(nodes, get='duration;distance', tileSize=20, workers=1, outFile=outFile)
+    assert server.requests == before
+
+
+def test_cache_serves_warm_matrix(server, tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    nodes = _nodes(50)
+    cache = osrm.ODCache(path)
+    client = osrm.OSRMClient(server.url, cache=cache)
+    cold = client.odMatrix(nodes, get='duration;distance')
+    before = server.requests
+    warm = client.odMatrix(nodes, get='duration;distance')
+    assert server.requests == before
+    assert np.array_equal(cold[0], warm[0]) and np.array_equal(cold[1], warm[1])
+    cache.close()
+
+    # 重新開啟 SQLite 檔案後，只需請求新加入的點
+    client = osrm.OSRMClient(server.url, cache=osrm.ODCache(path))
+    before = server.requests
+    client.odMatrix(np.r_[nodes, _nodes(1, seed=1)])
+    assert server.requests - before == 2
+    assert client.route(nodes[0].tolist(), nodes[1].tolist()).distance == cold[1][0, 1]
+
+
+def test_cache_lru_counts_cells():
+    cache = osrm.ODCache(maxSize=1000)
+    nodes = _nodes(100)
+    cache.setMatrix('driving', 'duration', nodes, nodes, np.ones((100, 100)))
+    assert cache.stats()['memorySize'] <= 1000
+    assert np.isnan(cache.getMatrix('driving', 'duration', nodes[:1], nodes)).all()
+    assert (cache.getMatrix('driving', 'duration', nodes[-10:], nodes) == 1).all()
+
+
+def test_odmatrix_add_remove_and_compaction(server):
+    client = osrm.OSRMClient(server.url)
+    nodes = _nodes(40)
+    matx = osrm.ODMatrix(nodes[:5], client=client, get='duration')
+    matx.addNodes(nodes[5:])
+    assert matx._capacity == 40
+
+    removed = list(range(3, 35))
+    matx.removeNodes(removed)
+    assert len(matx) == 8
+    assert matx._capacity == 20
+
+    keep = [key for key in range(40) if key not in removed]
+    order = [matx.index(key) for key in keep]
+    expected = client.odMatrix(nodes[keep], get='duration')
+    assert np.allclose(matx.matrix[np.ix_(order, order)], expected)
+
+
+@pytest.mark.parametrize('keys', [[1, 99], [1, 1]])
+def test_odmatrix_remove_validates_keys(server, keys):
+    matx = osrm.ODMatrix(_nodes(10), client=osrm.OSRMClient(server.url), get='duration')
+    before, beforeKeys = matx.matrix.copy(), list(matx.keys)
+    with pytest.raises(KeyError):
+        matx.removeNodes(keys)
+    assert matx.keys == beforeKeys
+    assert np.array_equal(matx.matrix, before)
+
+
+def test_nearest_neighbours_without_scipy(monkeypatch):
+    nodes = _nodes(500)
+    dist = osrm.haversineMatrix(nodes)
+    np.fill_diagonal(dist, np.inf)
+    expected = np.sort(np.argsort(dist, axis=1)[:, :5], axis=1)
+    monkeypatch.setattr(osrm, 'cKDTree', None)
+    got = osrm._nearestNeighbours(nodes, 5, memoryBudget=500 * 48 * 7)
+    assert np.array_equal(np.sort(got, axis=1), expected)
+
+
+@pytest.mark.parametrize('typicalLength', [osrm.HintCache.typicalLength, 1])
+def test_max_url_length_with_hints(server, typicalLength):
+    # typicalLength=1 模擬 hint 比預估長得多的情況，此時由 _tableTile 切開過長的區塊
+    hints = osrm.HintCache()
+    hints.typicalLength = typicalLength
+    client = osrm.OSRMClient(server.url, maxURLLength=4000, hints=hints)
+    lengths = []
+    client.stats.subscribe(lambda event, fields: lengths.append(fields['length']) if event == 'url' else None)
+    nodes = _nodes(400)
+    expected = osrm.OSRMClient(server.url).odMatrix(nodes)
+    for _ in range(2):
+        matx, fromOSRM = client.odMatrix(nodes, provenance=True)
+        assert fromOSRM.all() and np.array_equal(matx, expected)
+    assert server.hinted > 0
+    assert max(lengths) <= 4000
+
+
+def test_cache_single_cell_writes(tmp_path):
+    # route() 逐格寫入同一個起點（例如倉庫到各顧客）：先放在 pending，累積後才併入排序陣列
+    path = str(tmp_path / 'cache.sqlite')
+    cache = osrm.ODCache(path)
+    depot, customers = (121.5, 25.05), _nodes(300).tolist()
+    for k, customer in enumerate(customers):
+        cache.setMany([(cache.key('driving', depot, customer, 'distance'), float(k)),
+                       (cache.key('driving', depot, customer, 'duration'), float(-k))])
+        ids, _, _, pending = cache._rows[('driving', 'distance', int(cache.nodeIds([depot])[0]))]
+        assert len(pending) <= max(64, len(ids) // 4) + 1
+    assert cache.get(cache.key('driving', depot, customers[-1], 'distance')) == 299.0
+    assert cache.stats()['memorySize'] == 600
+
+    # 一次呼叫寫入同一列的多格，並覆蓋舊值
+    cache.setMany([(cache.key('driving', depot, customer, 'distance'), 1.0) for customer in customers[:10]])
+    cache.close()
+
+    cache = osrm.ODCache(path)
+    expected = np.arange(300.0)
+    expected[:10] = 1.0
+    assert np.array_equal(cache.getMatrix('driving', 'distance', [depot], customers)[0], expected)
+    assert np.array_equal(cache.getMatrix('driving', 'duration', [depot], customers)[0], -np.arange(300.0))
+    assert cache.getMany([cache.key('driving', depot, customers[5], 'distance'), cache.key('driving', customers[5], depot, 'distance')]) == [1.0, None]
+
+
+def test_rectangular_sources_and_destinations(server):
+    client = osrm.OSRMClient(server.url)
+    nodes = _nodes(30)
+    full = client.odMatrix(nodes, get='duration;distance')
+    cells = []
+    answer = server.answer
+
+    def countCells(service, coordinates, query):
+        status, info = answer(service, coordinates, query)
+        cells.append(np.size(info['durations']))
+        return status, info
+
+    server.answer = countCells
+    sources, destinations = [4, 0, 17], list(range(10, 30))
+    duration, distance = client.odMatrix(nodes, get='duration;distance', sources=sources, destinations=destinations)
+    assert duration.shape == distance.shape == (3, 20)
+    assert np.array_equal(duration, full[0][np.ix_(sources, destinations)])
+    assert np.array_equal(distance, full[1][np.ix_(sources, destinations)])
+    assert cells == [3 * 20]
+    server.answer = answer
+
+    assert np.array_equal(client.odMatrix(nodes, sources=0), full[1][:1])
+
+    # destnList 另外指定迄點座標，destinations 為 destnList 的索引
+    matx = client.odMatrix(nodes[:5], destnList=nodes[5:], destinations=[0, 2])
+    assert np.array_equal(matx, full[1][np.ix_(range(5), [5, 7])])
+
+
+@pytest.mark.parametrize('destnList', [None, _nodes(7, seed=1)])
+def test_rectangular_fallback_keeps_shape(destnList):
+    nodes = _nodes(12)
+    client = osrm.OSRMClient(DEAD_URL, retries=0)
+    matx, fromOSRM = client.odMatrix(nodes, sources=[1, 3], destinations=[0, 5, 6], destnList=destnList, provenance=True)
+    destn = nodes if destnList is None else destnList
+    assert matx.shape == fromOSRM.shape == (2, 3)
+    assert not fromOSRM.any()
+    assert np.allclose(matx, osrm.haversineMatrix(nodes[[1, 3]], destn[[0, 5, 6]]), atol=0.1)
+
+
+@pytest.mark.parametrize('n, requests', [(5, 1), (6, 2), (25, 6)])
+def test_distseq_chunks_overlap_at_max_waypoints(server, n, requests):
+    client = osrm.OSRMClient(server.url)
+    nodes = _nodes(n)
+    expected = [round(client.distance(*pair), 1) for pair in zip(nodes.tolist(), nodes[1:].tolist())]
+    waypoints = []
+    answer = server.answer
+
+    def countWaypoints(service, coordinates, query):
+        waypoints.append(len(server._coordinates(coordinates)))
+        return answer(service, coordinates, query)
+
+    server.answer = countWaypoints
+    assert client.distSeq(nodes, maxWaypoints=5) == expected
+    # 相鄰兩段共用交界的點：每段最多 5 個點，合計 n - 1 段 leg
+    assert len(waypoints) == requests and max(waypoints) <= 5
+    assert sum(count - 1 for count in waypoints) == n - 1
+
+
+def test_distseq_failed_chunk_falls_back_alone(server):
+    client = osrm.OSRMClient(server.url)
+    nodes = _nodes(13)
+    expected = client.distSeq(nodes)
+    answer = server.answer
+
+    # 各段並行請求，以起點判斷第二段（nodes[4:9]）並讓它回傳非 Ok
+    def failSecond(service, coordinates, query):
+        if np.allclose(server._coordinates(coordinates)[0], nodes[4], atol=1e-5):
+            return 400, {'code': 'NoRoute', 'message': 'Injected error'}
+        return answer(service, coordinates, query)
+
+    server.answer = failSecond
+    legs, fromOSRM = client.distSeq(nodes, maxWaypoints=5, provenance=True)
+    assert fromOSRM == [True] * 4 + [False] * 4 + [True] * 4
+    assert legs[:4] == expected[:4] and legs[8:] == expected[8:]
+    assert np.allclose(legs[4:8], osrm.haversinePairs(nodes[4:8], nodes[5:9]), atol=0.1)
@@ -0,0 +1,120 @@
+import time
+import warnings
+
+import numpy as np
+import pytest
+
+from osrm_api import osrm
+from osrm_api.fakeserver import FakeOSRMServer
+from conftest import DEAD_URL
+
+A, B = (121.5, 25.0), (121.55, 25.05)
+
+
+def _deadFirst(client):
+    # leastOutstanding 依 (進行中請求數, 延遲) 排序，讓無法連線的伺服器排在第一位
+    client.backends.backends[0].latency = -1.0
+
+
+@pytest.mark.parametrize('hedge', [False, True])
+def test_failover_to_live_backend(server, hedge):
+    client = osrm.OSRMClient([DEAD_URL, server.url], memoTTL=0, retries=0)
+    client.backends.hedge = hedge
+    _deadFirst(client)
+    assert [client.route(A, B).source for _ in range(3)] == ['osrm'] * 3
+    assert not client.stats.fallbacks
+
+
+@pytest.mark.parametrize('hedge', [False, True])
+def test_exhausted_pool_falls_back(hedge):
+    client = osrm.OSRMClient([DEAD_URL, 'http://127.0.0.1:8'], memoTTL=0, retries=0)
+    client.backends.hedge = hedge
+    with pytest.warns(UserWarning):
+        warnings.simplefilter('always')
+        assert client.route(A, B).source == 'haversine'
+    assert client.stats.fallbacks == {'error': 1}
+
+
+def test_hedge_goes_to_secondary_when_primary_is_slow(server):
+    with FakeOSRMServer(latency=0.5) as slow:
+        client = osrm.OSRMClient([slow.url, server.url], memoTTL=0)
+        client.backends.hedge = True
+        primary, secondary = client.backends.backends
+        primary.samples.extend([0.01] * 30)
+        primary.latency, secondary.latency = 0.0, 1.0
+        start = time.monotonic()
+        assert client.route(A, B).source == 'osrm'
+        assert time.monotonic() - start < 0.4
+        assert server.requests == 1
+
+
+def test_connection_errors_fall_back_then_open_breaker():
+    client = osrm.OSRMClient(DEAD_URL, retries=0, memoTTL=0, breaker=osrm.CircuitBreaker(threshold=2, cooldown=60))
+    assert [client.route(A, B).source for _ in range(4)] == ['haversine'] * 4
+    assert client.stats.fallbacks == {'error': 2, 'circuit': 2}
+    assert client.breaker.state == 'open'
+
+
+def test_half_open_probe_failing_with_bad_body_reopens(server):
+    client = osrm.OSRMClient(server.url, memoTTL=0, breaker=osrm.CircuitBreaker(threshold=1, cooldown=0.05))
+    server.errorRate = 1.0
+    assert client.route(A, B).source == 'haversine'
+    assert client.breaker.state == 'open'
+    server.errorRate = 0.0
+    time.sleep(0.1)
+
+    answer = server.answer
+    server.answer = lambda *args: (200, ['not', 'an', 'object'])
+    assert client.route(A, B).source == 'haversine'
+    assert client.breaker.state == 'open'
+    assert client.stats.fallbacks['error'] == 1
+
+    server.answer = answer
+    time.sleep(0.1)
+    assert client.route(A, B).source == 'osrm'
+    assert client.breaker.state == 'closed'
+
+
+def test_adaptive_timeout_recovers_after_slowdown(server):
+    client = osrm.OSRMClient(server.url, memoTTL=0, breaker=osrm.CircuitBreaker(threshold=3, cooldown=0.2))
+    for _ in range(30):
+        client.route(A, B)
+    assert client.timeouts['route'].get() == client.timeouts['route'].minimum
+
+    # 伺服器變得比目前的逾時還慢：逾時值須隨之增加，而非一直改用 haversine
+    server.latency = 0.8
+    sources = []
+    for _ in range(20):
+        sources.append(client.route(A, B).source)
+        time.sleep(0.05)
+    assert client.stats.fallbacks['timeout'] >= 1
+    assert sources[-5:] == ['osrm'] * 5
+    assert client.timeouts['route'].get() > 0.8
+    assert client.breaker.state == 'closed'
+
+
+def test_observe_timeout_grows_estimate():
+    timeout = osrm.AdaptiveTimeout(warmup=5, minimum=0.1)
+    for _ in range(10):
+        timeout.observe(0.01)
+    before = timeout.get()
+    timeout.observeTimeout(before)
+    timeout.observeTimeout(before)
+    assert timeout.get() > before
+
+
+def test_large_table_after_small_ones_is_not_cut_off(server):
+    # 以小矩陣學得的逾時不應套用到大上許多的矩陣
+    client = osrm.OSRMClient(server.url)
+    rng = np.random.default_rng(0)
+    for _ in range(30):
+        client.odMatrix(np.c_[rng.uniform(121.4, 121.6, 10), rng.uniform(25.0, 25.1, 10)])
+    assert client.timeouts['table'].get() < 1
+    nodes = np.c_[rng.uniform(121.4, 121.6, 1500), rng.uniform(25.0, 25.1, 1500)]
+    start = time.monotonic()
+    matx, fromOSRM = client.odMatrix(nodes, provenance=True)
+    elapsed = time.monotonic() - start
+    assert fromOSRM.all()
+    assert not client.stats.fallbacks
+    # 記錄大矩陣的延遲後，同樣大小的請求依樣本估計，仍足以涵蓋實際延遲
+    assert client.timeouts['table'].get(1 + 1500 ** 2 / 1e5) > elapsed
@@ -0,0 +1,70 @@
+import numpy as np
+
+from osrm_api import osrm
+
+A, B = (121.5, 25.0), (121.55, 25.05)
+
+
+def _nodes(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.c_[rng.uniform(121.4, 121.6, n), rng.uniform(25.0, 25.1, n)]
+
+
+def test_calls_counted_at_public_entry_only(server):
+    client = osrm.OSRMClient(server.url, memoTTL=0)
+    client.distance(A, B)
+    client.travTime(A, B)
+    client.route(A, B)
+    client.knnMatrix(_nodes(20), k=3)
+    assert client.stats.calls == {'distance': 1, 'travTime': 1, 'route': 1, 'knnMatrix': 1}
+    assert client.stats.snapshot()['requests']['route'] == 3
+
+
+def test_undecodable_tile_records_fallback(server):
+    client = osrm.OSRMClient(server.url)
+    answer = server.answer
+
+    def dropRow(service, coordinates, query):
+        status, info = answer(service, coordinates, query)
+        for name in ('durations', 'distances'):
+            if name in info:
+                info[name] = info[name][:-1]
+        return status, info
+
+    server.answer = dropRow
+    matx, fromOSRM = client.odMatrix(_nodes(10), provenance=True)
+    assert not fromOSRM.any()
+    assert client.stats.fallbacks == {'error': 1}
+    assert client.stats.values == {'haversine': 100}
+
+
+def test_null_cells_record_fallback_when_coalesced(server):
+    client = osrm.OSRMClient(server.url, memoTTL=0, coalesceWindow=0.01)
+    answer = server.answer
+
+    def nullCell(service, coordinates, query):
+        status, info = answer(service, coordinates, query)
+        info['durations'][0][0] = info['distances'][0][0] = None
+        return status, info
+
+    server.answer = nullCell
+    route = client.route(A, B)
+    assert route.source == 'haversine'
+    assert client.stats.fallbacks == {'code': 1}
+
+
+def test_provenance_marks_fallback_cells(server):
+    client = osrm.OSRMClient(server.url)
+    nodes = _nodes(30)
+    request, calls = client._request, []
+
+    def failFirst(*args, **kwargs):
+        calls.append(1)
+        return None if len(calls) == 1 else request(*args, **kwargs)
+
+    client._request = failFirst
+    matx, fromOSRM = client.odMatrix(nodes, tileSize=15, workers=1, provenance=True)
+    expected = osrm.haversineMatrix(nodes[:15])
+    assert not fromOSRM[:15, :15].any() and fromOSRM.sum() == 3 * 15 * 15
+    assert client.stats.values == {'haversine': 225, 'osrm': 675}
+    assert np.allclose(matx[:15, :15], np.round(expected, 1), atol=0.1)